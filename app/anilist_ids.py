@@ -0,0 +1,81 @@
+"""
+Fills the AnilistId table from the ARM mapping and the AniList cache
+(see mal_id/anilist_cache.py), so /query/ can join them in
+instead of reading the caches for each entry
+"""
+
+from pathlib import Path
+from typing import Dict, Tuple, Iterator
+
+import orjson
+from more_itertools import chunked
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session
+
+from mal_id.log import logger
+from mal_id.paths import anilist_cache as anilist_cache_dir
+from app.db import AnilistId, EntryType, data_engine
+from app.db_entry_update import mal_url_to_parts
+
+BATCH_SIZE = 500
+
+
+def _anilist_cache_pairs() -> Iterator[Tuple[int, EntryType, int]]:
+    """
+    reads the ids from the summaries in the anilist cache directly,
+    instead of going through AnilistCache.get for each url
+    """
+    for keyfile in (Path(anilist_cache_dir) / "data").rglob("*/key"):
+        metadata_file = keyfile.parent / "metadata.json"
+        if not metadata_file.exists():
+            continue
+        metadata = orjson.loads(metadata_file.read_bytes())
+        # 404s are saved with {"error": 404}
+        if metadata.get("id") is None:
+            continue
+        entry_type, mal_id = mal_url_to_parts(keyfile.read_text().strip())
+        yield mal_id, EntryType.from_str(entry_type), int(metadata["id"])
+
+
+def anilist_id_map() -> Dict[Tuple[int, EntryType], int]:
+    """
+    (mal_id, entry_type) -> anilist_id
+
+    ARM only has anime, the AniList cache has both and is
+    more up to date, so that replaces anything from ARM
+    """
+    from mal_id.arm import arm_index
+
+    ids: Dict[Tuple[int, EntryType], int] = {
+        (mal_id, EntryType.ANIME): anilist_id
+        for mal_id, anilist_id in arm_index().pairs("mal_id", "anilist_id")
+    }
+    from_arm = len(ids)
+    for mal_id, entry_type, anilist_id in _anilist_cache_pairs():
+        ids[(mal_id, entry_type)] = anilist_id
+    logger.info(f"anilist ids: {from_arm} from ARM, {len(ids)} total")
+    return ids
+
+
+def sync_anilist_ids(batch_size: int = BATCH_SIZE) -> int:
+    """
+    upserts every known anilist id into the AnilistId table, batch_size
+    rows per statement. returns how many rows were written
+    """
+    ids = anilist_id_map()
+    with Session(data_engine) as sess:
+        for batch in chunked(ids.items(), batch_size):
+            stmt = insert(AnilistId).values(
+                [
+                    {"mal_id": mal_id, "entry_type": entry_type, "anilist_id": aid}
+                    for (mal_id, entry_type), aid in batch
+                ]
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["mal_id", "entry_type"],
+                set_={"anilist_id": stmt.excluded.anilist_id},
+            )
+            sess.execute(stmt)
+        sess.commit()
+    logger.info(f"synced {len(ids)} anilist ids")
+    return len(ids)
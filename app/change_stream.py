@@ -0,0 +1,153 @@
+"""
+Pushes new status changes (see /changes/) to clients with server-sent events
+
+update_database usually runs in another process, so the StatusChange table
+is what connects the two. One background task tails the table and appends
+new changes to a bounded buffer, and each subscriber waits on a condition
+for new events, so idle subscribers don't query anything
+
+Clients which reconnect with a Last-Event-ID get the changes after that,
+from the buffer if they're still in it, else from the database
+"""
+
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Deque, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func
+from sqlmodel import Session
+from sqlmodel.sql.expression import select
+
+from mal_id.log import logger
+from app.db import StatusChange, read_engine, reload_if_replaced
+from app.executors import run_db
+from app.settings import settings
+
+# (id, serialized StatusChange)
+Event = Tuple[int, str]
+
+
+def _max_change_id() -> int:
+    reload_if_replaced()
+    with Session(read_engine) as sess:
+        return sess.exec(select(func.max(StatusChange.id))).one() or 0  # type: ignore[call-overload]
+
+
+def _events_after(last_id: int, limit: int) -> List[Event]:
+    reload_if_replaced()
+    with Session(read_engine) as sess:
+        changes = sess.exec(
+            select(StatusChange)
+            .where(StatusChange.id > last_id)  # type: ignore[operator]
+            .order_by(StatusChange.id)  # type: ignore[arg-type]
+            .limit(limit)
+        ).all()
+    return [(c.id, c.json()) for c in changes if c.id is not None]
+
+
+class ChangeBroadcaster:
+    def __init__(self, maxlen: int, poll_interval: float) -> None:
+        self.events: Deque[Event] = deque(maxlen=maxlen)
+        self.poll_interval = poll_interval
+        self.last_id = 0
+        self._cond = asyncio.Condition()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def start(self) -> None:
+        """starts tailing the table, the first time someone subscribes"""
+        if self._task is not None:
+            return
+        last_id = await run_db(_max_change_id)
+        # another subscriber may have started it while this was querying
+        if self._task is None:
+            self.last_id = last_id
+            self._task = asyncio.create_task(self._poll())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                events = await run_db(
+                    _events_after, self.last_id, self.events.maxlen or 1000
+                )
+            except Exception as e:
+                logger.exception("change stream: failed to read changes", exc_info=e)
+                continue
+            if not events:
+                continue
+            async with self._cond:
+                self.events.extend(events)
+                self.last_id = events[-1][0]
+                self._cond.notify_all()
+
+    def since(self, last_id: int) -> Optional[List[Event]]:
+        """events after last_id, or None if some of those were already dropped from the buffer"""
+        if last_id >= self.last_id:
+            return []
+        if not self.events or last_id < self.events[0][0] - 1:
+            return None
+        return [e for e in self.events if e[0] > last_id]
+
+    async def wait(self, last_id: int, timeout: float) -> bool:
+        """waits until there are events after last_id, returns False on timeout"""
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self.last_id > last_id), timeout
+                )
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+
+broadcaster = ChangeBroadcaster(
+    maxlen=settings.STREAM_BUFFER_SIZE, poll_interval=settings.STREAM_POLL_INTERVAL
+)
+
+
+def _format(event: Event) -> str:
+    return f"id: {event[0]}\nevent: status_change\ndata: {event[1]}\n\n"
+
+
+async def _event_stream(request: Request, last_id: int) -> AsyncIterator[str]:
+    while not await request.is_disconnected():
+        events = broadcaster.since(last_id)
+        if events is None:
+            # this client is behind whats in the buffer, catch up from the database
+            events = await run_db(_events_after, last_id, settings.STREAM_BUFFER_SIZE)
+        for event in events:
+            yield _format(event)
+            last_id = event[0]
+        if not events and not await broadcaster.wait(
+            last_id, settings.STREAM_KEEPALIVE
+        ):
+            # comment line, so proxies dont close the idle connection
+            yield ": keepalive\n\n"
+
+
+async def stream_changes(request: Request, last_id: Optional[int]) -> StreamingResponse:
+    await broadcaster.start()
+    return StreamingResponse(
+        _event_stream(request, broadcaster.last_id if last_id is None else last_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def test_broadcaster_since() -> None:
+    b = ChangeBroadcaster(maxlen=3, poll_interval=1)
+    assert b.since(0) == []
+    b.events.extend([(1, "a"), (2, "b"), (3, "c"), (4, "d")])
+    b.last_id = 4
+    assert b.since(4) == []
+    assert b.since(2) == [(3, "c"), (4, "d")]
+    assert b.since(1) == [(2, "b"), (3, "c"), (4, "d")]
+    # 1 was dropped from the buffer
+    assert b.since(0) is None
@@ -0,0 +1,127 @@
+from typing import List, Optional
+from datetime import datetime
+from pathlib import Path
+
+from fastapi import Depends, APIRouter, Query, Header, Request
+from fastapi.responses import StreamingResponse
+from sqlmodel import Session
+from sqlmodel.sql.expression import select
+from pydantic import BaseModel
+
+from app.db import get_read_db, EntryType, StatusChange
+from app.executors import run_db
+from app.change_stream import stream_changes
+
+router = APIRouter()
+
+
+class ChangesOut(BaseModel):
+    changes: List[StatusChange]
+    # pass this as 'since' to get the changes after these
+    next: int
+
+
+def _changes(
+    db: Session,
+    since: int,
+    since_time: Optional[datetime],
+    entry_type: Optional[EntryType],
+    limit: int,
+) -> ChangesOut:
+    # id is the rowid, so this is a range scan from the cursor
+    query = select(StatusChange).where(StatusChange.id > since)  # type: ignore[operator]
+    if since_time is not None:
+        query = query.where(StatusChange.recorded_at >= since_time)
+    if entry_type is not None:
+        query = query.where(StatusChange.entry_type == entry_type)
+    changes = db.exec(query.order_by(StatusChange.id).limit(limit)).all()  # type: ignore[arg-type]
+    return ChangesOut(
+        changes=changes,
+        next=changes[-1].id if changes else since,
+    )
+
+
+@router.get("/", response_model=ChangesOut)
+async def get_changes(
+    since: int = Query(default=0, ge=0, description="last change id seen"),
+    since_time: Optional[datetime] = Query(
+        default=None, description="only changes recorded after this time"
+    ),
+    entry_type: Optional[EntryType] = None,
+    limit: int = Query(default=500, ge=1, le=5000),
+    db: Session = Depends(get_read_db),
+) -> ChangesOut:
+    """
+    status changes (approved/unapproved/deleted/denied) in the order they were
+    written, to poll for new ones keep passing 'next' back as 'since'
+    """
+    return await run_db(_changes, db, since, since_time, entry_type, limit)
+
+
+@router.get("/stream")
+async def get_change_stream(
+    request: Request,
+    last_event_id: Optional[int] = Header(default=None),
+    since: Optional[int] = Query(
+        default=None,
+        description="last change id seen, if the Last-Event-ID header can't be set",
+    ),
+) -> StreamingResponse:
+    """
+    server-sent events for each new status change, the data is the same
+    as in /changes/. Without a Last-Event-ID or since, starts from now
+    """
+    return await stream_changes(
+        request, last_event_id if last_event_id is not None else since
+    )
+
+
+def test_changes(tmp_path: Path) -> None:
+    from sqlalchemy import create_engine
+    from sqlmodel import SQLModel
+
+    from app.db import Status
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'data.sqlite'}")
+    SQLModel.metadata.create_all(engine)
+    recorded_at = datetime(2023, 1, 1)
+    with Session(engine) as sess:
+        for i in range(1, 6):
+            sess.add(
+                StatusChange(
+                    entry_type=EntryType.ANIME if i % 2 else EntryType.MANGA,
+                    entry_id=i * 10,
+                    old_status=None,
+                    new_status=Status.APPROVED,
+                    status_changed_at=recorded_at,
+                    recorded_at=recorded_at.replace(day=i),
+                )
+            )
+        sess.commit()
+
+        out = _changes(sess, since=0, since_time=None, entry_type=None, limit=2)
+        assert [c.id for c in out.changes] == [1, 2]
+        assert out.next == 2
+        out = _changes(sess, since=out.next, since_time=None, entry_type=None, limit=5)
+        assert [c.id for c in out.changes] == [3, 4, 5]
+        assert out.next == 5
+
+        # nothing newer, keep polling from the same cursor
+        out = _changes(sess, since=5, since_time=None, entry_type=None, limit=5)
+        assert out.changes == []
+        assert out.next == 5
+
+        out = _changes(
+            sess, since=0, since_time=None, entry_type=EntryType.MANGA, limit=5
+        )
+        assert [c.entry_id for c in out.changes] == [20, 40]
+        assert out.next == 4
+        out = _changes(
+            sess,
+            since=0,
+            since_time=recorded_at.replace(day=4),
+            entry_type=None,
+            limit=5,
+        )
+        assert [c.id for c in out.changes] == [4, 5]
+    engine.dispose()
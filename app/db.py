@@ -1,11 +1,16 @@
+import os
 import enum
-from typing import Iterator, Optional, Dict, Any
+from threading import Lock
+from typing import Iterator, Optional, Dict, Any, Tuple
 from datetime import datetime, date
 
+from sqlalchemy import event, Index
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from sqlmodel import SQLModel, Field, create_engine, Session, Column, JSON
 
 from mal_id.log import logger
-from mal_id.paths import sqlite_db_uri
+from mal_id.paths import sqlite_db_path, sqlite_db_uri
 
 from app.settings import settings
 
@@ -37,6 +42,8 @@ class ApprovedBase(SQLModel, table=False):
     id: int = Field(primary_key=True)
     title: str
     nsfw: Optional[bool]
+    # only the keys from the MAL API response that list queries need (see LIST_JSON_KEYS),
+    # the full response is stored in the corresponding *MetadataJson table
     json_data: Dict[str, Any] = Field(default={}, sa_column=Column(JSON))
     approved_status: Status = Field(default=Status.UNAPPROVED)
     media_type: Optional[str] = Field(default=None)
@@ -50,14 +57,72 @@ class ApprovedBase(SQLModel, table=False):
     end_date: Optional[date]
 
 
+# the /query/ route is almost always filtered by approved_status and sorted by one of
+# these (the frontend links to status_changed_at/id sorts for each status), so index each
+# of them with approved_status first. member_count/status_changed_at/updated_at are
+# also commonly sorted on without a status filter, so they get their own index
+# approved_status on its own is ordered by rowid, which covers the default id sort
+STATUS_SORT_COLUMNS = (
+    "title",
+    "start_date",
+    "end_date",
+    "status_changed_at",
+    "updated_at",
+    "member_count",
+    "average_episode_duration",
+)
+UNFILTERED_SORT_COLUMNS = ("status_changed_at", "updated_at", "member_count")
+
+
+def sort_indexes(table_name: str) -> Tuple[Index, ...]:
+    return (
+        (Index(f"ix_{table_name}_approved_status", "approved_status"),)
+        + tuple(
+            Index(f"ix_{table_name}_approved_status_{col}", "approved_status", col)
+            for col in STATUS_SORT_COLUMNS
+        )
+        + tuple(Index(f"ix_{table_name}_{col}", col) for col in UNFILTERED_SORT_COLUMNS)
+    )
+
+
 class AnimeMetadata(ApprovedBase, table=True):
-    pass
+    __table_args__ = sort_indexes("animemetadata")
 
 
 class MangaMetadata(ApprovedBase, table=True):
+    __table_args__ = sort_indexes("mangametadata")
+
+
+class JsonDataBase(SQLModel, table=False):
+    # the full MAL API response, only loaded for /query/id/ and non-approved entries
+    id: int = Field(primary_key=True)
+    json_data: Dict[str, Any] = Field(default={}, sa_column=Column(JSON))
+
+
+class AnimeMetadataJson(JsonDataBase, table=True):
+    pass
+
+
+class MangaMetadataJson(JsonDataBase, table=True):
     pass
 
 
+# keys used by /query/ to render list results/filter on genres, the rest
+# of the API response is only kept in the json tables
+LIST_JSON_KEYS = {
+    "alternative_titles",
+    "main_picture",
+    "genres",
+    "num_episodes",
+    "num_chapters",
+    "num_volumes",
+}
+
+
+def list_json_data(json_data: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in json_data.items() if k in LIST_JSON_KEYS}
+
+
 class ProxiedImage(SQLModel, table=True):
     mal_id: int = Field(primary_key=True)
     mal_entry_type: EntryType = Field(primary_key=True)
@@ -71,9 +136,70 @@ class AnilistId(SQLModel, table=True):
     anilist_id: int = Field()
 
 
+class StatusChange(SQLModel, table=True):
+    """
+    append-only log of approved_status changes, written in the same
+    transaction as the entry update. id is the cursor for /changes/
+    """
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    entry_type: EntryType
+    entry_id: int
+    # None if the entry wasn't in the database before
+    old_status: Optional[Status]
+    new_status: Status
+    # when the entry was approved/denied/deleted etc., same as on the metadata tables
+    status_changed_at: Optional[datetime]
+    # when this change was written to the database
+    recorded_at: datetime = Field(index=True)
+
+
 connect_args = {"check_same_thread": False, "timeout": 15}
-data_engine = create_engine(
-    sqlite_db_uri, echo=settings.SQL_ECHO, connect_args=connect_args
+
+
+def _apply_pragmas(dbapi_connection: Any, read_only: bool) -> None:
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        # in WAL mode readers dont block behind the writer (and vice versa)
+        # this is persisted in the database file, so only the writer sets it
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    if read_only:
+        # not using mode=ro in the URI, since a read-only connection
+        # can't create the -shm file if no writer has the database open
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def create_data_engine(
+    uri: str = sqlite_db_uri, *, read_only: bool = False, pool_size: int = 5
+) -> Engine:
+    """
+    the default pool for sqlite files is NullPool, which would re-open the
+    database (and lose the page cache/mmap) for every session, so use a QueuePool
+    """
+    engine = create_engine(
+        uri,
+        echo=settings.SQL_ECHO,
+        connect_args=connect_args,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+    )
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection: Any, connection_record: Any) -> None:
+        _apply_pragmas(dbapi_connection, read_only=read_only)
+
+    return engine
+
+
+data_engine = create_data_engine()
+# used by the query routes, so they dont share connections with updates
+read_engine = create_data_engine(
+    read_only=True, pool_size=settings.SQLITE_READ_POOL_SIZE
 )
 
 
@@ -82,6 +208,44 @@ def init_db() -> None:
     SQLModel.metadata.create_all(data_engine)
 
 
+def _db_inode() -> Optional[int]:
+    try:
+        return os.stat(sqlite_db_path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+_loaded_inode = _db_inode()
+_reload_lock = Lock()
+
+
+def reload_if_replaced() -> bool:
+    """
+    if the database file was replaced (e.g. when there wasn't one, app/rebuild.py
+    moves the file it built into place), dispose the engines so new sessions open the new file. Sessions which are already
+    running finish on the old file, and those connections are closed when returned
+    """
+    global _loaded_inode
+    inode = _db_inode()
+    if inode is None or inode == _loaded_inode:
+        return False
+    with _reload_lock:
+        if inode == _loaded_inode:
+            return False
+        logger.info(f"database file {sqlite_db_path} was replaced, reloading engines")
+        data_engine.dispose()
+        read_engine.dispose()
+        _loaded_inode = inode
+    return True
+
+
 def get_db() -> Iterator[Session]:
+    reload_if_replaced()
     with Session(data_engine) as session:
         yield session
+
+
+def get_read_db() -> Iterator[Session]:
+    reload_if_replaced()
+    with Session(read_engine) as session:
+        yield session
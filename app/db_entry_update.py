@@ -1,32 +1,42 @@
-from typing import Optional, Set, Dict, Any, Tuple, List, Mapping, NamedTuple
+from typing import Optional, Set, Dict, Any, Tuple, List, Mapping, NamedTuple, Type
 from datetime import datetime, date, timedelta
-from asyncio import sleep
 from collections import defaultdict
 from pathlib import Path
 
 from urllib.parse import urlparse
+import orjson
 from malexport.parse.common import parse_date_safe
 from sqlalchemy import update
 from sqlmodel import Session
 from sqlmodel.sql.expression import select
 from url_cache.core import Summary
 
-from mal_id.metadata_cache import request_metadata
+from mal_id.metadata_cache import request_metadata, metadata_cache
 from mal_id.linear_history import iter_linear_history, Entry
-from mal_id.ids import approved_ids, unapproved_ids
-from mal_id.paths import metadatacache_dir
+from mal_id.ids import approved_ids, unapproved_ids, unapproved_deltas
+from mal_id.paths import metadatacache_dir, unapproved_cursor_path
 from mal_id.log import logger
 from mal_id.common import to_utc
 
 from app.db import (
+    ApprovedBase,
     Status,
     AnimeMetadata,
     MangaMetadata,
+    JsonDataBase,
+    AnimeMetadataJson,
+    MangaMetadataJson,
+    list_json_data,
     data_engine,
     ProxiedImage,
     EntryType,
+    StatusChange,
+    reload_if_replaced,
 )
 from app.image_proxy import proxy_image
+from app.executors import run_db, run_network
+from app.prefetch import prefetch
+from app.refresh_schedule import RefreshScheduler, RefreshCandidate
 
 
 def api_url_to_parts(url: str) -> tuple[str, int]:
@@ -88,6 +98,25 @@ def is_nsfw(jdata: Dict[str, Any]) -> Optional[bool]:
     return None
 
 
+def metadata_values(jdata: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    pops the values stored as columns on the metadata tables from the MAL
+    API response, what's left in jdata is what's stored in the json table
+    """
+    values = {
+        "title": jdata.pop("title"),
+        "media_type": jdata.pop("media_type", None),
+        "start_date": parse_date_safe(jdata.pop("start_date", None)),
+        "end_date": parse_date_safe(jdata.pop("end_date", None)),
+        "member_count": jdata.pop("num_list_users", None),
+        "average_episode_duration": jdata.pop("average_episode_duration", None),
+    }
+    # try to figure out if this is sfw/nsfw
+    values["nsfw"] = is_nsfw(jdata)
+    values["json_data"] = list_json_data(jdata)
+    return values
+
+
 def _get_img_url(data: dict) -> str | None:
     if img := data.get("medium"):
         assert isinstance(img, str)
@@ -111,6 +140,187 @@ async def summary_proxy_image(summary: Summary) -> str | None:
     return None
 
 
+def _image_rows_for(
+    entry_enum: EntryType, url_id: int
+) -> Dict[Tuple[EntryType, int], ImageData]:
+    with Session(data_engine) as sess:
+        return {
+            (i.mal_entry_type, i.mal_id): ImageData(
+                mal_url=i.mal_url,
+                proxied_url=i.proxied_url,
+            )
+            for i in sess.exec(
+                select(ProxiedImage)
+                .where(ProxiedImage.mal_id == url_id)
+                .where(ProxiedImage.mal_entry_type == entry_enum)
+            ).all()
+        }
+
+
+def _add_proxied_image(
+    entry_enum: EntryType, url_id: int, mal_image_url: str, proxied_url: str
+) -> None:
+    with Session(data_engine) as sess:
+        sess.add(
+            ProxiedImage(
+                mal_entry_type=entry_enum,
+                mal_id=url_id,
+                mal_url=mal_image_url,
+                proxied_url=proxied_url,
+            )
+        )
+        sess.commit()
+
+
+def _update_proxied_image(
+    entry_enum: EntryType, url_id: int, mal_image_url: str, proxied_url: str
+) -> None:
+    with Session(data_engine) as sess:
+        sess.exec(
+            update(ProxiedImage)  # type: ignore
+            .where(ProxiedImage.mal_entry_type == entry_enum)
+            .where(ProxiedImage.mal_id == url_id)
+            .values(mal_url=mal_image_url, proxied_url=proxied_url)
+        )
+        sess.commit()
+
+
+def _current_status(
+    use_model: Type[ApprovedBase], aid: int
+) -> Tuple[bool, Optional[Status]]:
+    """
+    returns whether the entry is in the db, and its current status
+    """
+    with Session(data_engine) as sess:
+        entry_req = sess.exec(select(use_model).where(use_model.id == aid)).first()
+    if entry_req is None:
+        return False, None
+    return True, entry_req.approved_status
+
+
+def _update_entry(
+    stmt: Any, json_row: JsonDataBase, change: Optional[StatusChange] = None
+) -> None:
+    with Session(data_engine) as sess:
+        sess.exec(stmt)
+        sess.merge(json_row)
+        if change is not None:
+            sess.add(change)
+        sess.commit()
+
+
+def _add_entry(
+    row: ApprovedBase, json_row: JsonDataBase, change: Optional[StatusChange] = None
+) -> None:
+    with Session(data_engine) as sess:
+        sess.add(row)
+        sess.merge(json_row)
+        if change is not None:
+            sess.add(change)
+        sess.commit()
+
+
+def _status_change(
+    entry_enum: EntryType,
+    aid: int,
+    old_status: Optional[Status],
+    new_status: Optional[Status],
+    status_changed_at: Optional[datetime],
+) -> Optional[StatusChange]:
+    if new_status is None or new_status == old_status:
+        return None
+    return StatusChange(
+        entry_type=entry_enum,
+        entry_id=aid,
+        old_status=old_status,
+        new_status=new_status,
+        status_changed_at=status_changed_at,
+        recorded_at=datetime.now(),
+    )
+
+
+def test_status_change_log(tmp_path: Path, monkeypatch: Any) -> None:
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import IntegrityError
+    from sqlmodel import SQLModel
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'data.sqlite'}")
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setitem(globals(), "data_engine", engine)
+    now = datetime(2023, 1, 1)
+
+    def _log() -> List[Tuple[int, Optional[Status], Status]]:
+        with Session(engine) as sess:
+            return [
+                (c.entry_id, c.old_status, c.new_status)
+                for c in sess.exec(select(StatusChange).order_by(StatusChange.id))  # type: ignore[arg-type]
+            ]
+
+    def _status() -> Status:
+        with Session(engine) as sess:
+            row = sess.get(AnimeMetadata, 1)
+            assert row is not None
+            return row.approved_status
+
+    def _update(
+        old_status: Status, new_status: Status, change: Optional[StatusChange] = None
+    ) -> None:
+        stmt = (
+            update(AnimeMetadata)
+            .where(AnimeMetadata.id == 1)  # type: ignore[attr-defined]
+            .values(approved_status=new_status, status_changed_at=now)
+        )
+        if change is None:
+            change = _status_change(EntryType.ANIME, 1, old_status, new_status, now)
+        _update_entry(stmt, AnimeMetadataJson(id=1, json_data={}), change)
+
+    # new entry
+    _add_entry(
+        AnimeMetadata(
+            id=1,
+            title="1",
+            nsfw=False,
+            approved_status=Status.UNAPPROVED,
+            status_changed_at=now,
+            updated_at=now,
+            start_date=None,
+            end_date=None,
+        ),
+        AnimeMetadataJson(id=1, json_data={}),
+        _status_change(EntryType.ANIME, 1, None, Status.UNAPPROVED, now),
+    )
+    assert _log() == [(1, None, Status.UNAPPROVED)]
+
+    # unchanged status
+    assert (
+        _status_change(EntryType.ANIME, 1, Status.UNAPPROVED, Status.UNAPPROVED, now)
+        is None
+    )
+    _update(Status.UNAPPROVED, Status.UNAPPROVED)
+    assert len(_log()) == 1
+
+    _update(Status.UNAPPROVED, Status.APPROVED)
+    assert _status() == Status.APPROVED
+    assert _log() == [
+        (1, None, Status.UNAPPROVED),
+        (1, Status.UNAPPROVED, Status.APPROVED),
+    ]
+
+    # the change is in the same commit, if it cant be written the entry isn't updated
+    broken = _status_change(EntryType.ANIME, 1, Status.APPROVED, Status.DELETED, now)
+    assert broken is not None
+    broken.recorded_at = None  # type: ignore[assignment]
+    try:
+        _update(Status.APPROVED, Status.DELETED, broken)
+    except IntegrityError:
+        pass
+    else:
+        raise AssertionError("expected IntegrityError for the broken change")
+    assert _status() == Status.APPROVED
+    assert len(_log()) == 2
+    engine.dispose()
+
+
 async def add_or_update(
     *,
     summary: Summary,
@@ -153,13 +363,12 @@ async def add_or_update(
 
     if skip_images is False:
         img = await summary_proxy_image(summary)  # this is where the image is proxied
-        await sleep(0)
         # may be that the summary is so old a new image has been added instead
         if img is None and refresh_images is True:
-            summary = request_metadata(url_id, entry_type, force_rerequest=True)
-            await sleep(0)
+            summary = await run_network(
+                request_metadata, url_id, entry_type, force_rerequest=True
+            )
             img = await summary_proxy_image(summary)
-            await sleep(0)
             if img is not None:
                 logger.info(
                     f"db: {entry_type} {url_id} successfully refreshed image {img}"
@@ -169,19 +378,7 @@ async def add_or_update(
         # mal_id_to_image is passed in a full update
         if mal_id_to_image is None:
             logger.debug(f"db: {entry_type} {url_id} fetching image row from db")
-            with Session(data_engine) as sess:
-                mal_id_to_image = {
-                    (i.mal_entry_type, i.mal_id): ImageData(
-                        mal_url=i.mal_url,
-                        proxied_url=i.proxied_url,
-                    )
-                    for i in sess.exec(
-                        select(ProxiedImage)
-                        .where(ProxiedImage.mal_id == url_id)
-                        .where(ProxiedImage.mal_entry_type == entry_enum)
-                    ).all()
-                }
-            await sleep(0)
+            mal_id_to_image = await run_db(_image_rows_for, entry_enum, url_id)
 
         assert mal_id_to_image is not None
 
@@ -195,17 +392,9 @@ async def add_or_update(
                 # if this isn't already in the database
                 if image_key not in mal_id_to_image:
                     logger.info(f"db: adding proxied image for {entry_type} {url_id}")
-                    with Session(data_engine) as sess:
-                        sess.add(
-                            ProxiedImage(
-                                mal_entry_type=entry_enum,
-                                mal_id=url_id,
-                                mal_url=mal_image_url,
-                                proxied_url=img,
-                            )
-                        )
-                        sess.commit()
-                    await sleep(0)
+                    await run_db(
+                        _add_proxied_image, entry_enum, url_id, mal_image_url, img
+                    )
                 else:
                     # if we have the image in the database and it is different
                     if (
@@ -215,53 +404,35 @@ async def add_or_update(
                         logger.info(
                             f"db: mal or proxied image changed for {entry_type} {url_id}"
                         )
-                        with Session(data_engine) as sess:
-                            sess.exec(
-                                update(ProxiedImage)  # type: ignore
-                                .where(ProxiedImage.mal_entry_type == entry_enum)
-                                .where(ProxiedImage.mal_id == url_id)
-                                .values(mal_url=mal_image_url, proxied_url=img)
-                            )
-                            sess.commit()
-                        await sleep(0)
+                        await run_db(
+                            _update_proxied_image,
+                            entry_enum,
+                            url_id,
+                            mal_image_url,
+                            img,
+                        )
 
                 # we should also check if the main image has changed, and if so, update it
 
     use_model = AnimeMetadata if entry_type == "anime" else MangaMetadata
+    json_model = AnimeMetadataJson if entry_type == "anime" else MangaMetadataJson
 
-    title = jdata.pop("title")
-    media_type = jdata.pop("media_type", None)
-    start_date = parse_date_safe(jdata.pop("start_date", None))
-    end_date = parse_date_safe(jdata.pop("end_date", None))
-    member_count = jdata.pop("num_list_users", None)
-    average_episode_duration = jdata.pop("average_episode_duration", None)
-
-    # try to figure out if this is sfw/nsfw
-    nsfw = is_nsfw(jdata)
+    values = metadata_values(jdata)
 
     # figure out if entry is the in db
     # if force rerequesting, dont have access to in_db/statuses
     entry_in_db = False
     if in_db is not None:
         entry_in_db = aid in in_db
+        # if we have a current status, use it
+        if old_status is None:
+            _, old_status = await run_db(_current_status, use_model, aid)
     else:
-        with Session(data_engine) as sess:
-            entry_req = sess.exec(select(use_model).where(use_model.id == aid)).first()
-            entry_in_db = entry_req is not None
-            await sleep(0)
-
-            # if we have the entry in the db, get the current status
-            # 'denied' entries need this to function so were not writing all the time
-            if old_status is None and entry_req is not None:
-                old_status = entry_req.approved_status
-
-    # if we have a current status, use it
-    if old_status is None:
-        with Session(data_engine) as sess:
-            entry_req = sess.exec(select(use_model).where(use_model.id == aid)).first()
-            if entry_req is not None:
-                old_status = entry_req.approved_status
-        await sleep(0)
+        # if we have the entry in the db, get the current status
+        # 'denied' entries need this to function so were not writing all the time
+        entry_in_db, db_status = await run_db(_current_status, use_model, aid)
+        if old_status is None:
+            old_status = db_status
 
     if entry_in_db:
         # update the entry if the status has changed or if this didn't exist in the db
@@ -288,22 +459,20 @@ async def add_or_update(
             stmt = (
                 update(use_model)
                 .where(use_model.id == aid)  # type: ignore[attr-defined]
-                .values(
-                    title=title,
-                    start_date=start_date,
-                    end_date=end_date,
-                    json_data=jdata,
-                    media_type=media_type,
-                    updated_at=summary.timestamp,
-                    member_count=member_count,
-                    average_episode_duration=average_episode_duration,
-                    nsfw=nsfw,
-                    **kwargs,
-                )
+                .values(updated_at=summary.timestamp, **values, **kwargs)
+            )
+            await run_db(
+                _update_entry,
+                stmt,
+                json_model(id=aid, json_data=jdata),
+                _status_change(
+                    entry_enum,
+                    aid,
+                    old_status,
+                    current_approved_status,
+                    status_changed_at,
+                ),
             )
-            with Session(data_engine) as sess:
-                sess.exec(stmt)  # type: ignore[call-overload]
-                sess.commit()
     else:
         if current_approved_status is None:
             logger.warning(
@@ -317,28 +486,24 @@ async def add_or_update(
             return
         logger.info(f"adding {entry_type} {aid} to db")
         # add the entry
-        with Session(data_engine) as sess:
-            assert summary.timestamp is not None
-            sess.add(
-                use_model(
-                    approved_status=current_approved_status,
-                    status_changed_at=status_changed_at,
-                    id=aid,
-                    title=title,
-                    start_date=start_date,
-                    end_date=end_date,
-                    media_type=media_type,
-                    updated_at=summary.timestamp,
-                    json_data=jdata,
-                    member_count=member_count,
-                    average_episode_duration=average_episode_duration,
-                    nsfw=nsfw,
-                )
-            )
-            sess.commit()
+        assert summary.timestamp is not None
+        await run_db(
+            _add_entry,
+            use_model(
+                approved_status=current_approved_status,
+                status_changed_at=status_changed_at,
+                id=aid,
+                updated_at=summary.timestamp,
+                **values,
+            ),
+            json_model(id=aid, json_data=jdata),
+            _status_change(
+                entry_enum, aid, None, current_approved_status, status_changed_at
+            ),
+        )
 
 
-async def status_map() -> Dict[str, Any]:
+def _status_map() -> Dict[str, Any]:
     with Session(data_engine) as sess:
         in_db: Dict[str, Any] = {
             "anime_tup": set(
@@ -357,6 +522,10 @@ async def status_map() -> Dict[str, Any]:
     return in_db
 
 
+async def status_map() -> Dict[str, Any]:
+    return await run_db(_status_map)
+
+
 def malid_to_image() -> Dict[Tuple[EntryType, int], ImageData]:
     with Session(data_engine) as sess:
         return {
@@ -376,6 +545,18 @@ def parse_datetime_from_dict(data: dict, key: str) -> Optional[datetime]:
     return None
 
 
+def approved_datetime(summary: Summary, first_appeared: datetime) -> datetime:
+    entry_created_at = parse_datetime_from_dict(summary.metadata, "created_at")
+    # this was the date mal-id-cache metadata was created, so if its before that, use
+    # the MAL API created_at field. otherwise, use when it appeared in our
+    # cache, since otherwise the created_at is when the entry was submitted
+    # by a user to MAL, not when it was approved
+    if entry_created_at is not None and entry_created_at.date() < date(2022, 3, 15):
+        return entry_created_at
+    # use the first value from git history
+    return first_appeared
+
+
 def unapproved_summary_datetime(summary: Summary) -> datetime:
     if dd := parse_datetime_from_dict(summary.metadata, "created_at"):
         return dd
@@ -397,11 +578,50 @@ def deleted_last_datetime(
     return max(map(to_utc, dates))
 
 
+def _linear_history_map() -> Mapping[Tuple[int, str], List[Entry]]:
+    history_map: Mapping[Tuple[int, str], List[Entry]] = defaultdict(list)
+    for ent in iter_linear_history():
+        history_map[(ent.entry_id, ent.e_type)].append(ent)
+    return history_map
+
+
+def _cached_metadata_urls() -> Set[str]:
+    all_urls = set()
+    for keyfile in (Path(metadatacache_dir) / "data").rglob("*/key"):
+        all_urls.add(keyfile.read_text().strip())
+    return all_urls
+
+
+def _unapproved_removed_at() -> Tuple[Dict[str, datetime], Dict[str, int]]:
+    """
+    when entries were removed from the unapproved lists since the last update,
+    and the cursor to save once this update is done
+    """
+    cursor = {"anime": 0, "manga": 0}
+    if unapproved_cursor_path.exists():
+        cursor.update(orjson.loads(unapproved_cursor_path.read_bytes()))
+    removed_at: Dict[str, datetime] = {}
+    for etype in ("anime", "manga"):
+        for delta in unapproved_deltas(etype, since=cursor[etype]):
+            for eid in delta.removed:
+                removed_at[f"{etype}_{eid}"] = datetime.fromtimestamp(delta.at)
+            # was removed and then added back
+            for eid in delta.added:
+                removed_at.pop(f"{etype}_{eid}", None)
+            cursor[etype] = delta.seq
+    return removed_at, cursor
+
+
+def _save_unapproved_cursor(cursor: Dict[str, int]) -> None:
+    unapproved_cursor_path.write_bytes(orjson.dumps(cursor))
+
+
 async def update_database(
     refresh_images: bool = False,
     force_update_db: bool = False,
     skip_proxy_images: bool = False,
-    # updates this many entries of data if the data is older than 'update_if_older_than'
+    # updates up to this many entries of data if the data is older than 'update_if_older_than'
+    # (manga is twice that), see app/refresh_schedule.py for the order/hourly budget
     update_outdated_metadata: Optional[int] = None,
     update_if_older_than: timedelta = timedelta(days=182),  # 6 months
 ) -> None:
@@ -412,97 +632,64 @@ async def update_database(
     #  make sure MAL API is up
     from mal_id.metadata_cache import check_mal
 
-    if not check_mal():
+    if not await run_network(check_mal):
         logger.warning("mal api is down, skipping db update")
         return
 
     logger.info("Updating database...")
+    # if the database was rebuilt since the last update, dont write to the old file
+    await run_db(reload_if_replaced)
 
     known: Set[str] = set()
     in_db = await status_map()
-    mal_id_image_have = malid_to_image()
+    mal_id_image_have = await run_db(malid_to_image)
 
-    expired_entries: int = 0
+    scheduler = RefreshScheduler(update_if_older_than, now=now)
+    # expired entries are written once the scheduler has picked which of them
+    # to re-request, so the ones it refreshes aren't written twice
+    deferred: Dict[Tuple[str, int], Dict[str, Any]] = {}
 
-    approved = approved_ids()
+    approved = await run_network(approved_ids)
     logger.info("db: reading from linear history...")
 
     # create a map from ID -> List[Entry]
-    history_map: Mapping[Tuple[int, str], List[Entry]] = defaultdict(list)
-    for ent in iter_linear_history():
-        history_map[(ent.entry_id, ent.e_type)].append(ent)
+    history_map = await run_network(_linear_history_map)
+
+    def _history_metadata(key: Tuple[int, str]) -> Summary:
+        r_id, r_type = key
+        approved_use = approved.anime if r_type == "anime" else approved.manga
+        # if it was unapproved and is now approved, re-request the data
+        was_approved = (
+            r_id in approved_use
+            and in_db[f"{r_type}_status"].get(r_id) == Status.UNAPPROVED
+        )
+        if was_approved:
+            logger.info(
+                f"updating {r_type} {r_id} to approved (was unapproved), rerequesting data"
+            )
+        return request_metadata(r_id, r_type, force_rerequest=was_approved)
 
-    for (r_id, r_type), r_appearances in history_map.items():
+    async for (r_id, r_type), smmry in prefetch(history_map, _history_metadata):
+        r_appearances = history_map[(r_id, r_type)]
         # sort by timestamp
         r_appearances.sort(key=lambda x: x.dt)
 
         assert r_type in ("anime", "manga")
-        approved_use: Set[int] = approved.anime if r_type == "anime" else approved.manga
+        approved_use = approved.anime if r_type == "anime" else approved.manga
 
         # if its in the linear history, it was approved at one point
         # but it may not be anymore
         current_id_status = Status.APPROVED if r_id in approved_use else Status.DELETED
-
         old_status = in_db[f"{r_type}_status"].get(r_id)
-        was_approved = False
-        if current_id_status == Status.APPROVED and old_status == Status.UNAPPROVED:
-            logger.info(
-                f"updating {r_type} {r_id} to approved (was unapproved), rerequesting data"
-            )
-            was_approved = True
-
-        smmry = request_metadata(r_id, r_type, force_rerequest=was_approved)
 
         if "error" in smmry.metadata:
             logger.debug(f"skipping http error in {r_type} {r_id}")
             continue
 
-        # if we're trying to refresh a couple entries each time we update, do that
-        force_db_update_for_this_entry = force_update_db
-        if update_outdated_metadata is not None and update_outdated_metadata > 0:
-            # check if its expired
-            requested_at = smmry.timestamp
-            assert requested_at is not None
-            # update manga at a slower rate
-            upd = (
-                update_if_older_than
-                if r_type == "anime"
-                else timedelta(days=update_if_older_than.days * 2)
-            )
-            if now - requested_at > upd:
-                logger.info(
-                    f"Rerequesting expired data for {r_type} {r_id}, requesting {update_outdated_metadata} more..."
-                )
-                update_outdated_metadata -= 1
-                force_db_update_for_this_entry = True
-                # print old main image and whether its proxied or not
-                old_main_image = summary_main_image(smmry)
-                if old_main_image is None:
-                    logger.info("old main image: None")
-                else:
-                    logger.info(f"old main image: {old_main_image}")
-                smmry = request_metadata(r_id, r_type, force_rerequest=True)
-        else:
-            requested_at = smmry.timestamp
-            assert requested_at is not None
-            if now - requested_at > update_if_older_than:
-                expired_entries += 1
-
         # figure out when this was approved/deleted
         status_changed_at = None
         if current_id_status == Status.APPROVED:
-            entry_created_at = parse_datetime_from_dict(smmry.metadata, "created_at")
-            # this was the date mal-id-cache metadata was created, so if its before that, use
-            # the MAL API created_at field. otherwise, use when it appeared in our
-            # cache, since otherwise the created_at is when the entry was submitted
-            # by a user to MAL, not when it was approved
-            if entry_created_at is not None and entry_created_at.date() < date(
-                2022, 3, 15
-            ):
-                status_changed_at = entry_created_at
-            else:
-                # use the first value from git history
-                status_changed_at = r_appearances[0].dt
+            status_changed_at = approved_datetime(smmry, r_appearances[0].dt)
         elif current_id_status == Status.DELETED:
             status_changed_at = deleted_last_datetime(
                 smmry, dates=[r.dt for r in r_appearances if r.action is False]
@@ -512,7 +699,7 @@ async def update_database(
             status_changed_at is not None
         ), f"no status changed at for {r_id} {r_type}"
 
-        await add_or_update(
+        update_kwargs: Dict[str, Any] = dict(
             summary=smmry,
             entry_id=r_id,
             current_approved_status=current_id_status,
@@ -520,23 +707,75 @@ async def update_database(
             in_db=in_db[r_type],
             status_changed_at=status_changed_at,
             refresh_images=refresh_images,
-            force_update=force_db_update_for_this_entry,
+            force_update=force_update_db,
             skip_images=skip_proxy_images,
             mal_id_to_image=mal_id_image_have,
         )
         ekey = r_appearances[0].key
         known.add(ekey)
 
-    logger.info(f"db: {expired_entries} entries are currently expired")
+        assert smmry.timestamp is not None
+        expired = scheduler.add(
+            RefreshCandidate(
+                entry_type=r_type,
+                entry_id=r_id,
+                requested_at=smmry.timestamp,
+                member_count=smmry.metadata.get("num_list_users") or 0,
+                update_kwargs={
+                    "current_approved_status": current_id_status,
+                    "status_changed_at": status_changed_at,
+                },
+            )
+        )
+        if expired and update_outdated_metadata is not None:
+            deferred[(r_type, r_id)] = update_kwargs
+        else:
+            await add_or_update(**update_kwargs)
 
-    unapproved = unapproved_ids()
+    # save the hourly budget even if MAL goes down part way through
+    try:
+        # if we're trying to refresh a couple entries each time we update, do that
+        if update_outdated_metadata is not None:
+            for cand in scheduler.pop(update_outdated_metadata):
+                logger.info(
+                    f"Rerequesting expired data for {cand.entry_type} {cand.entry_id} (last requested {cand.requested_at}, {cand.member_count} members)"
+                )
+                smmry = await run_network(
+                    request_metadata,
+                    cand.entry_id,
+                    cand.entry_type,
+                    force_rerequest=True,
+                )
+                await add_or_update(
+                    summary=smmry,
+                    entry_id=cand.entry_id,
+                    refresh_images=refresh_images,
+                    force_update=True,
+                    skip_images=skip_proxy_images,
+                    mal_id_to_image=mal_id_image_have,
+                    **cand.update_kwargs,
+                )
+                del deferred[(cand.entry_type, cand.entry_id)]
+        # expired entries which weren't refreshed this run, using the data we have
+        for update_kwargs in deferred.values():
+            await add_or_update(**update_kwargs)
+    finally:
+        await run_network(scheduler.save)
+
+    unapproved = await run_network(unapproved_ids)
+    # entries which left the unapproved list were denied/deleted around then,
+    # which is usually later than anything in their cached metadata
+    removed_at, unapproved_cursor = await run_network(_unapproved_removed_at)
     logger.info("db: updating from unapproved anime history...")
+    unapproved_anime = []
     for aid in unapproved.anime:
-        aid_key = f"anime_{aid}"
-        if aid_key in known:
+        if f"anime_{aid}" in known:
             logger.warning(f"skipping anime {aid} as it was already processed this run")
             continue
-        smmry = request_metadata(aid, "anime")
+        unapproved_anime.append(aid)
+    async for aid, smmry in prefetch(
+        unapproved_anime, lambda aid: request_metadata(aid, "anime")
+    ):
         await add_or_update(
             summary=smmry,
             entry_id=aid,
@@ -549,15 +788,18 @@ async def update_database(
             skip_images=skip_proxy_images,
             mal_id_to_image=mal_id_image_have,
         )
-        known.add(aid_key)
+        known.add(f"anime_{aid}")
 
     logger.info("db: updating from unapproved manga history...")
+    unapproved_manga = []
     for mid in unapproved.manga:
-        mid_key = f"manga_{mid}"
-        if mid_key in known:
+        if f"manga_{mid}" in known:
             logger.warning(f"skipping manga {mid} as it was already processed this run")
             continue
-        smmry = request_metadata(mid, "manga")
+        unapproved_manga.append(mid)
+    async for mid, smmry in prefetch(
+        unapproved_manga, lambda mid: request_metadata(mid, "manga")
+    ):
         await add_or_update(
             summary=smmry,
             entry_id=mid,
@@ -570,26 +812,30 @@ async def update_database(
             skip_images=skip_proxy_images,
             mal_id_to_image=mal_id_image_have,
         )
-        known.add(mid_key)
+        known.add(f"manga_{mid}")
 
     logger.info("db: checking for deleted entries...")
     # check if any other items exist that aren't in the db already
     # those were denied or deleted (long time ago)
-    all_urls = set()
-    for keyfile in (Path(metadatacache_dir) / "data").rglob("*/key"):
-        all_urls.add(keyfile.read_text().strip())
-    for entry_type, entry_id in map(mal_url_to_parts, all_urls):
+    all_urls = await run_network(_cached_metadata_urls)
+    cached_entries = [
+        (entry_type, entry_id)
+        for entry_type, entry_id in map(mal_url_to_parts, all_urls)
+        if f"{entry_type}_{entry_id}" not in known
+    ]
+    async for (entry_type, entry_id), smmry in prefetch(
+        cached_entries, lambda e: request_metadata(e[1], e[0])
+    ):
         key = f"{entry_type}_{entry_id}"
-        if key in known:
-            continue
         old_status = in_db[f"{entry_type}_status"].get(entry_id)
-        smmry = request_metadata(entry_id, entry_type)
         await add_or_update(
             summary=smmry,
             entry_id=entry_id,
             in_db=in_db[entry_type],
             old_status=old_status,
-            status_changed_at=deleted_last_datetime(smmry),
+            status_changed_at=deleted_last_datetime(
+                smmry, dates=[removed_at[key]] if key in removed_at else None
+            ),
             current_approved_status=Status.DENIED,
             refresh_images=refresh_images,
             force_update=force_update_db,
@@ -598,12 +844,15 @@ async def update_database(
         )
         known.add(key)
 
+    await run_network(_save_unapproved_cursor, unapproved_cursor)
+    logger.info(f"db: metadata lru stats {metadata_cache().lru.stats()}")
     logger.info("db: done with full update")
 
 
 async def refresh_entry(*, entry_id: int, entry_type: str) -> None:
-    summary = request_metadata(entry_id, entry_type, force_rerequest=True)
-    await sleep(0)
+    summary = await run_network(
+        request_metadata, entry_id, entry_type, force_rerequest=True
+    )
     logger.info(f"db: refreshed data for {entry_type} {entry_id}")
     # just update the basic metadata
     # Note:
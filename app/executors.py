@@ -0,0 +1,73 @@
+"""
+Bounded thread pools for the blocking work done from async code
+
+The sqlite sessions, the MAL API/metadata cache and boto3 are all synchronous,
+so instead of calling them directly (which stalls the event loop while
+they run), the async functions hand them off to one of these pools:
+
+- db: sqlalchemy sessions against the sqlite database
+- network: MAL API requests/metadata cache reads (request_metadata etc.)
+- s3: image uploads using boto3
+"""
+
+import asyncio
+from functools import cache, partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar, ParamSpec
+
+from app.settings import settings
+
+T = TypeVar("T")
+P = ParamSpec("P")
+
+
+@cache
+def db_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=settings.DB_POOL_WORKERS, thread_name_prefix="dbsentinel-db"
+    )
+
+
+@cache
+def network_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=settings.NETWORK_POOL_WORKERS,
+        thread_name_prefix="dbsentinel-network",
+    )
+
+
+@cache
+def s3_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=settings.S3_POOL_WORKERS, thread_name_prefix="dbsentinel-s3"
+    )
+
+
+async def _run_in(
+    pool: ThreadPoolExecutor, func: Callable[P, T], *args: P.args, **kwargs: P.kwargs
+) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, partial(func, *args, **kwargs))
+
+
+async def run_db(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    return await _run_in(db_pool(), func, *args, **kwargs)
+
+
+async def run_network(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    return await _run_in(network_pool(), func, *args, **kwargs)
+
+
+async def run_s3(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    return await _run_in(s3_pool(), func, *args, **kwargs)
+
+
+def shutdown(wait: bool = True) -> None:
+    """
+    waits for any pending work and stops the pools
+    any pools which were never used are not created
+    """
+    for pool_func in (db_pool, network_pool, s3_pool):
+        if pool_func.cache_info().currsize > 0:
+            pool_func().shutdown(wait=wait)
+            pool_func.cache_clear()
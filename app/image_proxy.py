@@ -1,27 +1,41 @@
 import io
 import json
-import time
 import shutil
+import asyncio
 import atexit
-from typing import cast
+from typing import Any, cast
 from pathlib import Path
 from urllib.parse import urlparse
 from functools import cache
+from threading import Lock
 
 import backoff
 import httpx
-import boto3  # type: ignore[import]
 import pickledb  # type: ignore[import]
 
 from mal_id.paths import image_data
 from mal_id.log import logger
 from app.settings import settings
+from app.executors import run_s3
+
+
+S3_CLIENT_LOCK = Lock()
+
+
+@cache
+def s3_client() -> Any:
+    # boto3 is slow to import, so this is created the first time an image is uploaded.
+    # creating clients isn't thread safe, and this is called from the s3 pool
+    with S3_CLIENT_LOCK:
+        import boto3  # type: ignore[import]
+
+        return boto3.client(
+            "s3",
+            aws_access_key_id=settings.S3_ACCESS_KEY,
+            aws_secret_access_key=settings.S3_SECRET_KEY,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+        )
 
-client = boto3.client(
-    "s3",
-    aws_access_key_id=settings.S3_ACCESS_KEY,
-    aws_secret_access_key=settings.S3_SECRET_KEY,
-)
 
 AUTO_DUMP = settings.IMAGE_CACHE_AUTO_DUMP
 
@@ -70,7 +84,7 @@ async def _get_image_bytes(url: str) -> bytes | None:
             return None
         elif resp.status_code == 429:
             logger.warning(f"image_proxy: got 429 for {url}")
-            time.sleep(15)
+            await asyncio.sleep(15)
             return await _get_image_bytes(url)
         resp.raise_for_status()
         return resp.content
@@ -112,7 +126,8 @@ async def proxy_image(url: str) -> str | None:
         key = path.replace("/", "_").lstrip("_")
 
         # upload to aws s3
-        client.upload_fileobj(
+        await run_s3(
+            s3_client().upload_fileobj,
             io.BytesIO(image_bytes),
             Bucket=settings.S3_BUCKET,
             Key=key,
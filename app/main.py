@@ -16,6 +16,14 @@ def create_app() -> FastAPI:
 
         init_db()
 
+    @current_app.on_event("shutdown")
+    async def _shutdown() -> None:
+        from app.executors import shutdown
+        from app.change_stream import broadcaster
+
+        broadcaster.stop()
+        shutdown()
+
     @current_app.get("/ping")
     async def _ping() -> str:
         return "pong"
@@ -34,10 +42,12 @@ def create_app() -> FastAPI:
     from .tasks import router as tasks_router
     from .summary import router as summary_router
     from .query import router as query_router
+    from .changes import router as changes_router
 
     current_app.include_router(tasks_router, prefix="/tasks")
     current_app.include_router(summary_router, prefix="/summary")
     current_app.include_router(query_router, prefix="/query")
+    current_app.include_router(changes_router, prefix="/changes")
 
     # https://github.com/tiangolo/fastapi/issues/3361#issuecomment-1002120988
     @current_app.exception_handler(RequestValidationError)
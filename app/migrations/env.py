@@ -18,7 +18,13 @@ if config.config_file_name is not None:
 
 # add your model's MetaData object here
 # for 'autogenerate' support
-from app.db import AnimeMetadata, MangaMetadata, ProxiedImage  # noqa
+from app.db import (  # noqa
+    AnimeMetadata,
+    MangaMetadata,
+    ProxiedImage,
+    AnimeMetadataJson,
+    MangaMetadataJson,
+)
 
 # from myapp import mymodel
 target_metadata = sqlmodel.SQLModel.metadata
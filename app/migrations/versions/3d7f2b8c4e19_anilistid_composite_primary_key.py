@@ -0,0 +1,35 @@
+"""anilistid composite primary key
+
+the earlier 'anilist composite key' migration only dropped the entry_type
+index, the primary key was still just mal_id, so an anime and a manga
+with the same MAL id couldn't both be stored
+
+Revision ID: 3d7f2b8c4e19
+Revises: 9f3b6c2e1a47
+Create Date: 2026-10-19 19:40:12.518204
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "3d7f2b8c4e19"
+down_revision = "9f3b6c2e1a47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # sqlite can't alter a primary key, so this copies the table
+    with op.batch_alter_table("anilistid", recreate="always") as batch_op:
+        batch_op.create_primary_key("pk_anilistid", ["mal_id", "entry_type"])
+
+
+def downgrade() -> None:
+    # drop any manga which share a MAL id with an anime, so mal_id is unique again
+    op.execute(
+        "DELETE FROM anilistid WHERE rowid NOT IN (SELECT MIN(rowid) FROM anilistid GROUP BY mal_id)"
+    )
+    with op.batch_alter_table("anilistid", recreate="always") as batch_op:
+        batch_op.create_primary_key("pk_anilistid", ["mal_id"])
@@ -0,0 +1,55 @@
+"""add query sort indexes
+
+Revision ID: 5c1e9a7d3b2f
+Revises: eab4157eae58
+Create Date: 2026-10-19 18:51:02.418223
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision = "5c1e9a7d3b2f"
+down_revision = "eab4157eae58"
+branch_labels = None
+depends_on = None
+
+TABLES = ["animemetadata", "mangametadata"]
+
+STATUS_SORT_COLUMNS = [
+    "title",
+    "start_date",
+    "end_date",
+    "status_changed_at",
+    "updated_at",
+    "member_count",
+    "average_episode_duration",
+]
+UNFILTERED_SORT_COLUMNS = ["status_changed_at", "updated_at", "member_count"]
+
+
+def upgrade() -> None:
+    for table in TABLES:
+        op.create_index(
+            f"ix_{table}_approved_status", table, ["approved_status"], unique=False
+        )
+        for col in STATUS_SORT_COLUMNS:
+            op.create_index(
+                f"ix_{table}_approved_status_{col}",
+                table,
+                ["approved_status", col],
+                unique=False,
+            )
+        for col in UNFILTERED_SORT_COLUMNS:
+            op.create_index(f"ix_{table}_{col}", table, [col], unique=False)
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        for col in UNFILTERED_SORT_COLUMNS:
+            op.drop_index(f"ix_{table}_{col}", table_name=table)
+        for col in STATUS_SORT_COLUMNS:
+            op.drop_index(f"ix_{table}_approved_status_{col}", table_name=table)
+        op.drop_index(f"ix_{table}_approved_status", table_name=table)
@@ -0,0 +1,42 @@
+"""add status change log
+
+Revision ID: 6a2e9d4f1c83
+Revises: 3d7f2b8c4e19
+Create Date: 2026-10-19 20:21:37.610447
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision = "6a2e9d4f1c83"
+down_revision = "3d7f2b8c4e19"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "statuschange",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("entry_type", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("entry_id", sa.Integer(), nullable=False),
+        sa.Column("old_status", sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+        sa.Column("new_status", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("status_changed_at", sa.DateTime(), nullable=True),
+        sa.Column("recorded_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_statuschange_recorded_at"),
+        "statuschange",
+        ["recorded_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_statuschange_recorded_at"), table_name="statuschange")
+    op.drop_table("statuschange")
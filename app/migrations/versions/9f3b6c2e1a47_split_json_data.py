@@ -0,0 +1,77 @@
+"""move full json_data into separate tables
+
+Revision ID: 9f3b6c2e1a47
+Revises: 5c1e9a7d3b2f
+Create Date: 2026-10-19 19:12:45.102934
+
+sqlite doesn't give the freed pages back to the filesystem, run
+sqlite3 data.sqlite 'VACUUM' after upgrading to shrink the file
+"""
+
+import json
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision = "9f3b6c2e1a47"
+down_revision = "5c1e9a7d3b2f"
+branch_labels = None
+depends_on = None
+
+TABLES = ["animemetadata", "mangametadata"]
+
+# app.db.LIST_JSON_KEYS
+LIST_JSON_KEYS = {
+    "alternative_titles",
+    "main_picture",
+    "genres",
+    "num_episodes",
+    "num_chapters",
+    "num_volumes",
+}
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    for table in TABLES:
+        op.create_table(
+            f"{table}json",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("json_data", sa.JSON(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+        conn.execute(
+            sa.text(
+                f"INSERT INTO {table}json (id, json_data) SELECT id, json_data FROM {table}"
+            )
+        )
+        rows = conn.execute(sa.text(f"SELECT id, json_data FROM {table}")).fetchall()
+        updates = []
+        for row_id, json_data in rows:
+            data = json.loads(json_data) if json_data else {}
+            updates.append(
+                {
+                    "id": row_id,
+                    "json_data": json.dumps(
+                        {k: v for k, v in data.items() if k in LIST_JSON_KEYS}
+                    ),
+                }
+            )
+        if updates:
+            conn.execute(
+                sa.text(f"UPDATE {table} SET json_data = :json_data WHERE id = :id"),
+                updates,
+            )
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    for table in TABLES:
+        conn.execute(
+            sa.text(
+                f"UPDATE {table} SET json_data = (SELECT j.json_data FROM {table}json j WHERE j.id = {table}.id) WHERE id IN (SELECT id FROM {table}json)"
+            )
+        )
+        op.drop_table(f"{table}json")
@@ -0,0 +1,89 @@
+"""
+Read-ahead for the loops in update_database
+
+Those visit entries in a known order, and each one blocks on reading (or
+requesting) the summary from the metadata cache before the database write can
+happen. This starts loading the next few summaries on the network pool while
+the current one is being written, keeping at most 'window' of them in memory
+"""
+
+import asyncio
+from collections import deque
+from typing import (
+    AsyncIterator,
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from app.executors import run_network
+from app.settings import settings
+
+K = TypeVar("K")
+T = TypeVar("T")
+
+
+async def prefetch(
+    keys: Iterable[K],
+    load: Callable[[K], T],
+    *,
+    window: Optional[int] = None,
+) -> AsyncIterator[Tuple[K, T]]:
+    """
+    yields (key, load(key)) in the same order as keys, with up to 'window'
+    load calls running/finished ahead of the one being yielded
+    """
+    if window is None:
+        window = settings.PREFETCH_WINDOW
+    assert window > 0
+    it: Iterator[K] = iter(keys)
+    pending: Deque[Tuple[K, asyncio.Future[T]]] = deque()
+
+    def _fill() -> None:
+        while len(pending) < window:
+            try:
+                key = next(it)
+            except StopIteration:
+                return
+            pending.append((key, asyncio.ensure_future(run_network(load, key))))
+
+    try:
+        _fill()
+        while pending:
+            key, fut = pending.popleft()
+            result = await fut
+            _fill()
+            yield key, result
+    finally:
+        # if the consumer stopped early/errored, dont start any more work
+        for _, fut in pending:
+            fut.cancel()
+
+
+def test_prefetch() -> None:
+    import time
+    import threading
+
+    started = []
+    lock = threading.Lock()
+
+    def _load(i: int) -> int:
+        with lock:
+            started.append(i)
+        # finish out of order
+        time.sleep(0.01 * (i % 3))
+        return i * 2
+
+    async def _run() -> None:
+        got = []
+        async for key, val in prefetch(range(20), _load, window=4):
+            # never more than 'window' ahead of what has been consumed
+            assert len(started) <= key + 1 + 4
+            got.append((key, val))
+        assert got == [(i, i * 2) for i in range(20)]
+
+    asyncio.run(_run())
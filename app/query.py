@@ -10,16 +10,20 @@ from pydantic import BaseModel, Field
 
 from mal_id.log import logger
 from app.db import (
-    get_db,
+    get_read_db,
     ApprovedBase,
     AnimeMetadata,
     ProxiedImage,
     EntryType,
     MangaMetadata,
+    AnilistId,
+    AnimeMetadataJson,
+    MangaMetadataJson,
     Status,
 )
 
 from app.db_entry_update import _get_img_url
+from app.executors import run_db
 
 router = APIRouter()
 
@@ -47,6 +51,7 @@ class QueryModelOut(BaseModel):
     status_updated_at: float
     start_date: str | None
     end_date: str | None
+    anilist_id: Optional[int] = None
 
 
 class QueryOut(BaseModel):
@@ -82,6 +87,7 @@ class QueryIn(BaseModel):
     sort: QueryInSort = Field(default=QueryInSort.DESC)
     limit: int = Field(default=100, le=250)
     offset: int = Field(default=0)
+    include_anilist: bool = Field(default=False)
 
 
 def _serialize_date(dd: date | None) -> Optional[str]:
@@ -114,11 +120,16 @@ def _pick_image(metadata: ApprovedBase, proxied: ProxiedImage | None) -> Optiona
         return proxied.proxied_url
 
 
-@router.post("/")
-async def media_query(info: QueryIn, sess: Session = Depends(get_db)) -> QueryOut:
-    logger.info(f"query: {info}")
+def build_media_query(info: QueryIn) -> Any:
+    """
+    builds the filtered/sorted select for /query/, without the limit/offset
+    """
     model = AnimeMetadata if info.entry_type == EntryType.ANIME else MangaMetadata
+    json_model = (
+        AnimeMetadataJson if info.entry_type == EntryType.ANIME else MangaMetadataJson
+    )
     entry_type = EntryType.from_str(info.entry_type)
+    joined_json = False
 
     # left join on proxied image
     query = select(model, ProxiedImage).join(
@@ -143,7 +154,13 @@ async def media_query(info: QueryIn, sess: Session = Depends(get_db)) -> QueryOu
                     model.json_data["genres"].map(lambda x: x["name"]).contains(value)
                 )
             else:
-                query = query.where(model.json_data.get(key, None) == value)
+                # other keys are only in the full API response
+                if not joined_json:
+                    query = query.join(json_model, json_model.id == model.id)
+                    joined_json = True
+                query = query.where(
+                    func.json_extract(json_model.json_data, f"$.{key}") == value
+                )
 
     if info.media_type is not None:
         query = query.where(model.media_type == info.media_type)
@@ -163,6 +180,11 @@ async def media_query(info: QueryIn, sess: Session = Depends(get_db)) -> QueryOu
         "average_episode_duration": model.average_episode_duration,
     }.get(info.order_by, model.id)
     query = query.order_by(order_attr.desc() if info.sort == "desc" else order_attr.asc())  # type: ignore
+    return query
+
+
+def _media_query(info: QueryIn, sess: Session) -> QueryOut:
+    query = build_media_query(info)
 
     count = sess.exec(select(func.count()).select_from(query.subquery())).first()  # type: ignore
     assert isinstance(count, int)
@@ -175,6 +197,34 @@ async def media_query(info: QueryIn, sess: Session = Depends(get_db)) -> QueryOu
 
     rows = sess.exec(query).all()  # type: ignore
 
+    # the list row only has LIST_JSON_KEYS, non-approved entries return the full
+    # API response, so fetch those from the json table for just this page
+    json_model = (
+        AnimeMetadataJson if info.entry_type == EntryType.ANIME else MangaMetadataJson
+    )
+    full_json: Dict[int, Dict[str, Any]] = {}
+    if non_approved := [
+        row.id for row, _ in rows if row.approved_status != Status.APPROVED
+    ]:
+        full_json = {
+            jrow.id: jrow.json_data
+            for jrow in sess.exec(
+                select(json_model).where(json_model.id.in_(non_approved))  # type: ignore[attr-defined]
+            ).all()
+        }
+
+    anilist_ids: Dict[int, int] = {}
+    if info.include_anilist and rows:
+        anilist_ids = {
+            mal_id: anilist_id
+            for mal_id, anilist_id in sess.exec(
+                select(AnilistId.mal_id, AnilistId.anilist_id).where(  # type: ignore[call-overload]
+                    AnilistId.entry_type == info.entry_type,
+                    AnilistId.mal_id.in_([row.id for row, _ in rows]),  # type: ignore[attr-defined]
+                )
+            ).all()
+        }
+
     return QueryOut(
         results=[
             QueryModelOut(
@@ -188,10 +238,13 @@ async def media_query(info: QueryIn, sess: Session = Depends(get_db)) -> QueryOu
                 status_updated_at=row.status_changed_at.timestamp(),
                 start_date=_serialize_date(row.start_date),
                 end_date=_serialize_date(row.end_date),
-                json_data=_filter_keys_for_status(row.json_data, row.approved_status),
+                json_data=_filter_keys_for_status(
+                    full_json.get(row.id, row.json_data), row.approved_status
+                ),
                 member_count=row.member_count,
                 average_episode_duration=row.average_episode_duration,
                 approved_status=row.approved_status,
+                anilist_id=anilist_ids.get(row.id),
             )
             for row, image in rows
         ],
@@ -200,6 +253,68 @@ async def media_query(info: QueryIn, sess: Session = Depends(get_db)) -> QueryOu
     )
 
 
+def _explain_query_plan(info: QueryIn) -> str:
+    from sqlmodel import SQLModel, create_engine
+
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    query = build_media_query(info).limit(info.limit).offset(info.offset)
+    sql = str(query.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    return "\n".join(row[-1] for row in plan)
+
+
+def test_query_plan_uses_sort_indexes() -> None:
+    for entry_type in EntryType:
+        table = "animemetadata" if entry_type == EntryType.ANIME else "mangametadata"
+        for order_by, column in [
+            (QueryInOrderBy.TITLE, "title"),
+            (QueryInOrderBy.START_DATE, "start_date"),
+            (QueryInOrderBy.END_DATE, "end_date"),
+            (QueryInOrderBy.STATUS_UPDATED_AT, "status_changed_at"),
+            (QueryInOrderBy.METADATA_UPDATED_AT, "updated_at"),
+            (QueryInOrderBy.MEMBER_COUNT, "member_count"),
+            (QueryInOrderBy.AVERAGE_EPISODE_DURATION, "average_episode_duration"),
+        ]:
+            for sort in QueryInSort:
+                plan = _explain_query_plan(
+                    QueryIn(
+                        entry_type=entry_type,
+                        approved_status=StatusIn.APPROVED,
+                        media_type="tv",
+                        order_by=order_by,
+                        sort=sort,
+                    )
+                )
+                assert f"USING INDEX ix_{table}_approved_status_{column}" in plan, plan
+                assert "TEMP B-TREE" not in plan, plan
+
+        for order_by, column in [
+            (QueryInOrderBy.STATUS_UPDATED_AT, "status_changed_at"),
+            (QueryInOrderBy.METADATA_UPDATED_AT, "updated_at"),
+            (QueryInOrderBy.MEMBER_COUNT, "member_count"),
+        ]:
+            plan = _explain_query_plan(
+                QueryIn(entry_type=entry_type, order_by=order_by, nsfw=False)
+            )
+            assert f"USING INDEX ix_{table}_{column}" in plan, plan
+            assert "TEMP B-TREE" not in plan, plan
+
+        # the default id sort walks the approved_status index in rowid order
+        plan = _explain_query_plan(
+            QueryIn(entry_type=entry_type, approved_status=StatusIn.DELETED)
+        )
+        assert f"USING INDEX ix_{table}_approved_status " in plan, plan
+        assert "TEMP B-TREE" not in plan, plan
+
+
+@router.post("/")
+async def media_query(info: QueryIn, sess: Session = Depends(get_read_db)) -> QueryOut:
+    logger.info(f"query: {info}")
+    return await run_db(_media_query, info, sess)
+
+
 class ByIdQueryIn(BaseModel):
     id: int
     entry_type: EntryType
@@ -211,18 +326,23 @@ class ByIdRawOut(BaseModel):
     json_data: dict
 
 
-@router.post("/id/")
-async def media_query_by_id(
-    info: ByIdQueryIn, sess: Session = Depends(get_db)
-) -> ByIdRawOut:
+def _media_query_by_id(info: ByIdQueryIn, sess: Session) -> ByIdRawOut:
     model = AnimeMetadata if info.entry_type == EntryType.ANIME else MangaMetadata
+    json_model = (
+        AnimeMetadataJson if info.entry_type == EntryType.ANIME else MangaMetadataJson
+    )
     entry_type = EntryType.from_str(info.entry_type)
 
-    # left join on proxied image
-    query = select(model, ProxiedImage).join(
-        ProxiedImage,
-        (model.id == ProxiedImage.mal_id) & (ProxiedImage.mal_entry_type == entry_type),
-        isouter=True,
+    # left join on proxied image and the full API response
+    query = (
+        select(model, ProxiedImage, json_model)
+        .join(
+            ProxiedImage,
+            (model.id == ProxiedImage.mal_id)
+            & (ProxiedImage.mal_entry_type == entry_type),
+            isouter=True,
+        )
+        .join(json_model, json_model.id == model.id, isouter=True)
     )
 
     query = query.where(model.id == info.id)
@@ -232,9 +352,9 @@ async def media_query_by_id(
     if len(res) == 0:
         raise HTTPException(status_code=404, detail="Entry not found")
 
-    row, image = res[0]
+    row, image, full = res[0]
 
-    json_data = row.json_data
+    json_data = dict(full.json_data if full is not None else row.json_data)
     json_data["title"] = row.title
     json_data["nsfw"] = row.nsfw
     json_data["approved_status"] = row.approved_status
@@ -252,5 +372,12 @@ async def media_query_by_id(
         id=row.id,
         title=row.title,
         proxied_image=image.proxied_url if image else None,
-        json_data=row.json_data,
+        json_data=json_data,
     )
+
+
+@router.post("/id/")
+async def media_query_by_id(
+    info: ByIdQueryIn, sess: Session = Depends(get_read_db)
+) -> ByIdRawOut:
+    return await run_db(_media_query_by_id, info, sess)
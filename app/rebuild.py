@@ -0,0 +1,537 @@
+"""
+Rebuilds the database from scratch using multiple processes
+
+Instead of running update_database over the whole catalog in one process,
+this plans out the status for each entry (from the linear history, the
+approved/unapproved ids and the metadata cache), splits that by ID range into
+shards, and builds the rows for each shard (json parsing, parse_date_safe,
+is_nsfw etc.) in a process pool. The main process is the only writer, it
+bulk inserts each shard into a shadow sqlite file as they finish. That's
+checked (integrity_check, row counts), and then the entry tables in the
+current database are replaced with its rows in a single transaction, so the
+API never reads a partially built one
+
+This only reads from the metadata cache, it doesn't request anything from
+MAL or proxy images. The proxiedimage/anilistid/statuschange tables in the
+current database are left as they are
+"""
+
+import os
+import time
+import sqlite3
+from contextlib import closing
+from functools import cache
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateTable
+from sqlmodel import SQLModel
+from url_cache.core import URLCache
+from url_cache.summary_cache import SummaryDirCache
+
+from mal_id.ids import approved_ids, unapproved_ids
+from mal_id.log import logger
+from mal_id.paths import metadatacache_dir, sqlite_db_path
+
+from app.db import Status
+from app.db_entry_update import (
+    _cached_metadata_urls,
+    _linear_history_map,
+    approved_datetime,
+    deleted_last_datetime,
+    mal_url_to_parts,
+    metadata_values,
+    unapproved_summary_datetime,
+)
+
+
+class RebuildTask(NamedTuple):
+    entry_type: str
+    entry_id: int
+    status: Status
+    # for entries in the linear history, when it first appeared/the times it was removed
+    first_appeared: Optional[datetime] = None
+    removed_at: Tuple[datetime, ...] = ()
+
+
+class ShardRows(NamedTuple):
+    # table name -> rows, with values already converted for sqlite (see _to_row)
+    rows: Dict[str, List[Tuple[Any, ...]]]
+    skipped: int
+
+
+# entry type -> (metadata table, json table)
+TABLES = {
+    "anime": ("animemetadata", "animemetadatajson"),
+    "manga": ("mangametadata", "mangametadatajson"),
+}
+
+# left as they are in the current database, since these cant be rebuilt from the cache
+KEPT_TABLES = ("proxiedimage", "anilistid", "statuschange")
+
+
+def plan_rebuild() -> List[RebuildTask]:
+    """
+    decides the status for each entry, in the same order of precedence
+    as update_database (linear history, then unapproved, then anything else
+    in the metadata cache)
+    """
+    approved = approved_ids()
+    tasks: Dict[Tuple[str, int], RebuildTask] = {}
+
+    for (r_id, r_type), r_appearances in _linear_history_map().items():
+        r_appearances.sort(key=lambda x: x.dt)
+        approved_use = approved.anime if r_type == "anime" else approved.manga
+        tasks[(r_type, r_id)] = RebuildTask(
+            entry_type=r_type,
+            entry_id=r_id,
+            status=Status.APPROVED if r_id in approved_use else Status.DELETED,
+            first_appeared=r_appearances[0].dt,
+            removed_at=tuple(r.dt for r in r_appearances if r.action is False),
+        )
+
+    unapproved = unapproved_ids()
+    for entry_type, ids in (("anime", unapproved.anime), ("manga", unapproved.manga)):
+        for entry_id in ids:
+            tasks.setdefault(
+                (entry_type, entry_id),
+                RebuildTask(entry_type, entry_id, Status.UNAPPROVED),
+            )
+
+    for entry_type, entry_id in map(mal_url_to_parts, _cached_metadata_urls()):
+        tasks.setdefault(
+            (entry_type, entry_id), RebuildTask(entry_type, entry_id, Status.DENIED)
+        )
+
+    return [tasks[k] for k in sorted(tasks)]
+
+
+def shard_tasks(
+    tasks: List[RebuildTask], shard_size: int
+) -> Iterator[List[RebuildTask]]:
+    """tasks are sorted by (entry_type, entry_id), so each shard is an ID range"""
+    for i in range(0, len(tasks), shard_size):
+        yield tasks[i : i + shard_size]
+
+
+@cache
+def _summary_cache() -> Tuple[URLCache, SummaryDirCache]:
+    # reads the files directly, MetadataCache would authenticate with MAL
+    ucache = URLCache(cache_dir=metadatacache_dir)
+    return ucache, ucache.summary_cache
+
+
+def _status_changed_at(task: RebuildTask, summary: Any) -> datetime:
+    if task.status == Status.APPROVED:
+        assert task.first_appeared is not None
+        return approved_datetime(summary, task.first_appeared)
+    elif task.status == Status.DELETED:
+        return deleted_last_datetime(summary, dates=list(task.removed_at))
+    elif task.status == Status.UNAPPROVED:
+        return unapproved_summary_datetime(summary)
+    else:
+        return deleted_last_datetime(summary)
+
+
+@cache
+def _bind_processors(table_name: str) -> List[Tuple[str, Optional[Callable]]]:
+    table = SQLModel.metadata.tables[table_name]
+    dialect = sqlite.dialect()
+    return [
+        (col.name, col.type.dialect_impl(dialect).bind_processor(dialect))
+        for col in table.columns
+    ]
+
+
+def _to_row(table_name: str, values: Dict[str, Any]) -> Tuple[Any, ...]:
+    """
+    converts the values to what sqlalchemy would send to sqlite (json/dates/enums),
+    so that work is done in the worker processes instead of the writer
+    """
+    return tuple(
+        proc(values[name]) if proc is not None else values[name]
+        for name, proc in _bind_processors(table_name)
+    )
+
+
+def _insert_sql(table_name: str) -> str:
+    columns = [name for name, _ in _bind_processors(table_name)]
+    return f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+
+
+def build_shard(tasks: List[RebuildTask]) -> ShardRows:
+    """runs in a worker process, builds the rows for each entry in the shard"""
+    ucache, summary_cache = _summary_cache()
+    rows: Dict[str, List[Tuple[Any, ...]]] = {
+        table_name: [] for table_names in TABLES.values() for table_name in table_names
+    }
+    skipped = 0
+    for task in tasks:
+        url = ucache.preprocess_url(
+            f"https://myanimelist.net/{task.entry_type}/{task.entry_id}"
+        )
+        summary = summary_cache.get(url)
+        # same checks as add_or_update
+        if (
+            summary is None
+            or "error" in summary.metadata
+            or "id" not in summary.metadata
+            or task.entry_id <= 0
+        ):
+            skipped += 1
+            continue
+        jdata = dict(summary.metadata)
+        jdata.pop("id")
+        assert summary.timestamp is not None
+        values = metadata_values(jdata)
+        use_table, json_table = TABLES[task.entry_type]
+        rows[use_table].append(
+            _to_row(
+                use_table,
+                dict(
+                    id=task.entry_id,
+                    approved_status=task.status,
+                    status_changed_at=_status_changed_at(task, summary),
+                    updated_at=summary.timestamp,
+                    **values,
+                ),
+            )
+        )
+        rows[json_table].append(
+            _to_row(json_table, {"id": task.entry_id, "json_data": jdata})
+        )
+    return ShardRows(rows=rows, skipped=skipped)
+
+
+def _build_engine(path: Path) -> Engine:
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection: Any, connection_record: Any) -> None:
+        # nothing reads this file until its done, if this crashes it just gets rebuilt
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=OFF")
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.close()
+
+    return engine
+
+
+class RebuildCheckError(Exception):
+    pass
+
+
+def _record_status_changes(conn: sqlite3.Connection) -> None:
+    """
+    the rebuild doesn't go through add_or_update, so compare the statuses
+    in the new database with the current ones to add any changes to the log
+    """
+    recorded_at = dict(_bind_processors("statuschange"))["recorded_at"]
+    assert recorded_at is not None
+    now = recorded_at(datetime.now())
+    for entry_type, (table, _) in TABLES.items():
+        cur = conn.execute(
+            f"""INSERT INTO main.statuschange (entry_type, entry_id, old_status, new_status, status_changed_at, recorded_at)
+            SELECT ?, n.id, o.approved_status, n.approved_status, n.status_changed_at, ?
+            FROM new.{table} n LEFT JOIN main.{table} o ON o.id = n.id
+            WHERE o.approved_status IS NOT n.approved_status
+            ORDER BY n.id""",
+            (entry_type, now),
+        )
+        logger.info(f"rebuild: {cur.rowcount} {entry_type} status changes")
+
+
+def build_database(
+    output: Path,
+    *,
+    workers: int = 4,
+    shard_size: int = 2000,
+) -> Dict[str, int]:
+    """
+    builds a new database at output, returns the number of rows in each table.
+    The KEPT_TABLES are left empty, swap_database doesn't replace those
+    """
+    if output.exists():
+        output.unlink()
+    start = time.perf_counter()
+    tasks = plan_rebuild()
+    logger.info(
+        f"rebuild: planned {len(tasks)} entries in {time.perf_counter() - start:.1f}s"
+    )
+
+    engine = _build_engine(output)
+    tables = SQLModel.metadata.sorted_tables
+    counts = {table.name: 0 for table in tables}
+    skipped = 0
+    with engine.begin() as conn:
+        # create the indexes after everything is inserted, its faster than updating them on each insert
+        for table in tables:
+            conn.execute(CreateTable(table))
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(build_shard, shard)
+                for shard in shard_tasks(tasks, shard_size)
+            ]
+            for fut in as_completed(futures):
+                shard = fut.result()
+                skipped += shard.skipped
+                for table in tables:
+                    if rows := shard.rows.get(table.name):
+                        conn.exec_driver_sql(_insert_sql(table.name), rows)  # type: ignore[arg-type]
+                        counts[table.name] += len(rows)
+
+        for table in tables:
+            for index in table.indexes:
+                index.create(conn)
+
+    engine.dispose()
+
+    logger.info(
+        f"rebuild: wrote {counts} ({skipped} skipped) to {output} in {time.perf_counter() - start:.1f}s"
+    )
+    return counts
+
+
+def _table_counts(conn: sqlite3.Connection) -> Dict[str, int]:
+    existing = {
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+    return {
+        table.name: conn.execute(f"SELECT COUNT(*) FROM {table.name}").fetchone()[0]
+        for table in SQLModel.metadata.sorted_tables
+        if table.name in existing
+    }
+
+
+def verify_database(
+    new_db: Path,
+    *,
+    expected: Dict[str, int],
+    old_db: Path = sqlite_db_path,
+    min_ratio: float = 0.95,
+) -> None:
+    """
+    checks the new database before its swapped in, raises RebuildCheckError if:
+
+    - sqlite's integrity_check fails
+    - the entry tables dont have the rows build_database inserted
+    - an entry table has less than min_ratio of the rows in the current database
+      (e.g. if the metadata cache was missing/only partially synced)
+    """
+    with closing(sqlite3.connect(new_db)) as conn:
+        integrity = conn.execute("PRAGMA integrity_check").fetchall()
+        if integrity != [("ok",)]:
+            raise RebuildCheckError(f"integrity check failed: {integrity}")
+        new_counts = _table_counts(conn)
+
+    for table, count in expected.items():
+        if table not in KEPT_TABLES and new_counts[table] != count:
+            raise RebuildCheckError(
+                f"{table} has {new_counts[table]} rows, expected {count}"
+            )
+
+    if not old_db.exists():
+        return
+    with closing(sqlite3.connect(old_db)) as conn:
+        old_counts = _table_counts(conn)
+    for table, old_count in old_counts.items():
+        new_count = new_counts[table]
+        if table not in KEPT_TABLES and new_count < old_count * min_ratio:
+            raise RebuildCheckError(
+                f"{table} has {new_count} rows, current database has {old_count} (min ratio {min_ratio})"
+            )
+    logger.info(f"rebuild: checked {new_db}, {new_counts} (current: {old_counts})")
+
+
+def _replace_tables(conn: sqlite3.Connection) -> Dict[str, int]:
+    """
+    replaces the rows in the rebuilt tables with the ones in the attached
+    'new' database, returns the number of rows in each
+    """
+    counts: Dict[str, int] = {}
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name in KEPT_TABLES:
+            continue
+        # the current database was created by the migrations, the column order may differ
+        columns = ", ".join(c.name for c in table.columns)
+        conn.execute(f"DELETE FROM main.{table.name}")
+        cur = conn.execute(
+            f"INSERT INTO main.{table.name} ({columns}) SELECT {columns} FROM new.{table.name}"
+        )
+        counts[table.name] = cur.rowcount
+    return counts
+
+
+def swap_database(
+    new_db: Path, *, expected: Dict[str, int], target: Path = sqlite_db_path
+) -> None:
+    """
+    replaces the entry tables in target with the ones in new_db, in one write
+    transaction on target. The KEPT_TABLES aren't touched, so nothing written
+    to those while the rebuild ran is lost, and the status change log is
+    added to in the same transaction
+
+    Renaming new_db over target isn't safe while other processes have it
+    open: the -wal/-shm files belong to the path, and the wal-index still
+    describes the old file. This writes through sqlite instead, so other
+    connections see the new rows like any other commit. Anything else
+    writing (the server, update-db) waits for the lock, up to the busy
+    timeout in app/db.py
+    """
+    if not target.exists():
+        logger.warning(f"rebuild: no database at {target}, moving {new_db} there")
+        os.replace(new_db, target)
+        return
+
+    start = time.perf_counter()
+    with closing(sqlite3.connect(target, isolation_level=None, timeout=15)) as conn:
+        conn.execute("ATTACH DATABASE ? AS new", (str(new_db),))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _record_status_changes(conn)
+            counts = _replace_tables(conn)
+            for table, count in counts.items():
+                if count != expected[table]:
+                    raise RebuildCheckError(
+                        f"copied {count} rows for {table}, expected {expected[table]}"
+                    )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        conn.execute("DETACH DATABASE new")
+    new_db.unlink()
+    logger.info(
+        f"rebuild: replaced the tables in {target}, held the write lock for {time.perf_counter() - start:.1f}s"
+    )
+
+
+def rebuild_database(
+    *, workers: int = 4, shard_size: int = 2000, min_ratio: float = 0.95
+) -> None:
+    """
+    builds into a shadow file next to the database, and only swaps it in
+    if it passes verify_database. If it doesn't, the shadow file is left for debugging
+    """
+    new_db = sqlite_db_path.with_name(f"{sqlite_db_path.name}.rebuild")
+    counts = build_database(new_db, workers=workers, shard_size=shard_size)
+    verify_database(new_db, expected=counts, min_ratio=min_ratio)
+    swap_database(new_db, expected=counts)
+
+
+def test_swap_database(tmp_path: Path) -> None:
+    from sqlmodel import Session, select
+    from app.db import (
+        AnimeMetadata,
+        AnimeMetadataJson,
+        EntryType,
+        ProxiedImage,
+        StatusChange,
+    )
+
+    now = datetime(2023, 1, 1)
+
+    def _create(path: Path, statuses: Dict[int, Status]) -> Engine:
+        engine = create_engine(f"sqlite:///{path}")
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as sess:
+            for entry_id, status in statuses.items():
+                sess.add(
+                    AnimeMetadata(
+                        id=entry_id,
+                        title=str(entry_id),
+                        nsfw=False,
+                        approved_status=status,
+                        status_changed_at=now,
+                        updated_at=now,
+                        start_date=None,
+                        end_date=None,
+                    )
+                )
+                sess.add(AnimeMetadataJson(id=entry_id, json_data={"id": entry_id}))
+            sess.commit()
+        return engine
+
+    target = tmp_path / "data.sqlite"
+    new_db = tmp_path / "data.sqlite.rebuild"
+    target_engine = _create(target, {1: Status.APPROVED, 2: Status.UNAPPROVED})
+    _create(
+        new_db, {1: Status.APPROVED, 2: Status.DENIED, 3: Status.APPROVED}
+    ).dispose()
+    with closing(sqlite3.connect(new_db)) as conn:
+        counts = _table_counts(conn)
+    assert counts["animemetadata"] == 3
+
+    # written by the server while the rebuild was running
+    with Session(target_engine) as sess:
+        sess.add(
+            ProxiedImage(
+                mal_id=1,
+                mal_entry_type=EntryType.ANIME,
+                mal_url="https://cdn.myanimelist.net/1.jpg",
+                proxied_url="https://s3/1.jpg",
+            )
+        )
+        sess.commit()
+
+    def _statuses() -> Dict[int, Status]:
+        with Session(target_engine) as sess:
+            return {
+                a.id: a.approved_status for a in sess.exec(select(AnimeMetadata)).all()
+            }
+
+    def _changes() -> List[Tuple[int, Optional[Status], Status]]:
+        with Session(target_engine) as sess:
+            return [
+                (c.entry_id, c.old_status, c.new_status)
+                for c in sess.exec(select(StatusChange).order_by(StatusChange.id)).all()  # type: ignore[arg-type]
+            ]
+
+    verify_database(new_db, expected=counts, old_db=target)
+    try:
+        verify_database(new_db, expected={**counts, "animemetadata": 4}, old_db=target)
+    except RebuildCheckError:
+        pass
+    else:
+        raise AssertionError("expected RebuildCheckError for the wrong row count")
+
+    # a mismatched count rolls back, leaving the target as it was
+    try:
+        swap_database(new_db, expected={**counts, "animemetadata": 4}, target=target)
+    except RebuildCheckError:
+        pass
+    else:
+        raise AssertionError("expected RebuildCheckError for the wrong row count")
+    assert _statuses() == {1: Status.APPROVED, 2: Status.UNAPPROVED}
+    assert _changes() == []
+    assert new_db.exists()
+
+    swap_database(new_db, expected=counts, target=target)
+    assert not new_db.exists()
+    assert _statuses() == {1: Status.APPROVED, 2: Status.DENIED, 3: Status.APPROVED}
+    assert _changes() == [
+        (2, Status.UNAPPROVED, Status.DENIED),
+        (3, None, Status.APPROVED),
+    ]
+    with Session(target_engine) as sess:
+        assert [i.mal_id for i in sess.exec(select(ProxiedImage)).all()] == [1]
+        assert sess.get(AnimeMetadataJson, 3) is not None
+    target_engine.dispose()
@@ -0,0 +1,156 @@
+"""
+Picks which expired entries to re-request from the MAL API in a full db update
+
+Instead of refreshing the first N expired entries in history order, every
+entry is added to a priority queue, ordered by how far past its expiry it is
+(relative to its max age) and how popular it is (member_count), so the
+stalest/most viewed entries are refreshed first
+
+The number of refreshes per hour is capped across runs, the state for that
+is saved to refresh_schedule_path
+"""
+
+import math
+import time
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import NamedTuple, Dict, Any, List, Tuple, Iterator, Optional
+
+import orjson
+
+from mal_id.log import logger
+from mal_id.paths import refresh_schedule_path
+from app.settings import settings
+
+HOUR = 60 * 60
+
+
+class RefreshCandidate(NamedTuple):
+    entry_type: str
+    entry_id: int
+    requested_at: datetime
+    member_count: int
+    # passed back to add_or_update once this is refreshed
+    update_kwargs: Dict[str, Any]
+
+
+class RefreshScheduler:
+    def __init__(
+        self,
+        max_age: timedelta,
+        *,
+        now: Optional[datetime] = None,
+        budget_per_hour: int = settings.REFRESH_BUDGET_PER_HOUR,
+        state_path: Path = refresh_schedule_path,
+    ) -> None:
+        self.max_age = max_age
+        self.now = now or datetime.now()
+        self.budget_per_hour = budget_per_hour
+        self.state_path = state_path
+        self.expired = 0
+        self.on_schedule = 0
+        self.refreshed = 0
+        self._heap: List[Tuple[float, int, RefreshCandidate]] = []
+        self._counter = itertools.count()
+        self.state: Dict[str, Any] = {"hour_started_at": time.time(), "used": 0}
+        if self.state_path.exists():
+            self.state = orjson.loads(self.state_path.read_bytes())
+
+    def max_age_for(self, entry_type: str) -> timedelta:
+        # update manga at a slower rate
+        if entry_type == "manga":
+            return self.max_age * 2
+        return self.max_age
+
+    @staticmethod
+    def priority(age: timedelta, max_age: timedelta, member_count: int) -> float:
+        return (age / max_age) * (1 + math.log10(1 + max(member_count, 0)))
+
+    def add(self, candidate: RefreshCandidate) -> bool:
+        """returns True if this entry is expired, and was queued"""
+        max_age = self.max_age_for(candidate.entry_type)
+        age = self.now - candidate.requested_at
+        if age <= max_age:
+            self.on_schedule += 1
+            return False
+        self.expired += 1
+        prio = self.priority(age, max_age, candidate.member_count)
+        # heapq is a min heap, so negate to pop the highest priority first
+        heapq.heappush(self._heap, (-prio, next(self._counter), candidate))
+        return True
+
+    def budget_remaining(self) -> int:
+        if time.time() - self.state["hour_started_at"] >= HOUR:
+            self.state = {"hour_started_at": time.time(), "used": 0}
+        return max(self.budget_per_hour - int(self.state["used"]), 0)
+
+    def pop(self, limit: int) -> Iterator[RefreshCandidate]:
+        """
+        yields up to 'limit' of the highest priority expired entries,
+        as long as there is budget left this hour
+        """
+        for _ in range(limit):
+            if not self._heap or self.budget_remaining() == 0:
+                return
+            _, _, candidate = heapq.heappop(self._heap)
+            self.state["used"] += 1
+            self.refreshed += 1
+            yield candidate
+
+    def report(self) -> str:
+        return f"{self.expired} entries are expired, {self.on_schedule} on schedule, refreshed {self.refreshed} ({self.budget_remaining()}/{self.budget_per_hour} left this hour)"
+
+    def save(self) -> None:
+        self.state["last_run"] = {
+            "at": time.time(),
+            "expired": self.expired,
+            "on_schedule": self.on_schedule,
+            "refreshed": self.refreshed,
+        }
+        self.state_path.write_bytes(orjson.dumps(self.state))
+        logger.info(f"refresh schedule: {self.report()}")
+
+
+def test_refresh_scheduler(tmp_path: Path) -> None:
+    now = datetime(2023, 1, 1)
+
+    def _candidate(
+        entry_type: str, entry_id: int, days: int, members: int
+    ) -> RefreshCandidate:
+        return RefreshCandidate(
+            entry_type=entry_type,
+            entry_id=entry_id,
+            requested_at=now - timedelta(days=days),
+            member_count=members,
+            update_kwargs={},
+        )
+
+    sched = RefreshScheduler(
+        timedelta(days=10),
+        now=now,
+        budget_per_hour=3,
+        state_path=tmp_path / "schedule.json",
+    )
+    assert not sched.add(_candidate("anime", 1, 5, 100))
+    # manga expire after twice as long
+    assert not sched.add(_candidate("manga", 2, 15, 100))
+    assert sched.add(_candidate("anime", 3, 11, 10))
+    assert sched.add(_candidate("anime", 4, 11, 100000))
+    assert sched.add(_candidate("anime", 5, 30, 10))
+    assert sched.add(_candidate("manga", 6, 25, 10))
+    assert (sched.expired, sched.on_schedule) == (4, 2)
+    assert [c.entry_id for c in sched.pop(2)] == [4, 5]
+    sched.save()
+
+    # budget is shared across runs
+    sched = RefreshScheduler(
+        timedelta(days=10),
+        now=now,
+        budget_per_hour=3,
+        state_path=tmp_path / "schedule.json",
+    )
+    sched.add(_candidate("anime", 3, 11, 10))
+    sched.add(_candidate("manga", 6, 25, 10))
+    assert [c.entry_id for c in sched.pop(5)] == [6]
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseSettings
 
 
@@ -7,7 +9,26 @@ class Settings(BaseSettings):
     S3_SECRET_KEY: str
     S3_BUCKET: str
     S3_URL_PREFIX: str
+    # for S3-compatible servers other than AWS, e.g. scripts/stub_services
+    S3_ENDPOINT_URL: Optional[str] = None
     IMAGE_CACHE_AUTO_DUMP: bool
+    # thread pools used to run blocking work from async code, see app/executors.py
+    DB_POOL_WORKERS: int = 4
+    NETWORK_POOL_WORKERS: int = 4
+    S3_POOL_WORKERS: int = 4
+    # sqlite connection tuning, see app/db.py
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_CACHE_SIZE: int = -64000  # negative is KiB, so ~64MB per connection
+    SQLITE_MMAP_SIZE: int = 268435456  # 256MB
+    SQLITE_READ_POOL_SIZE: int = 8
+    # max expired entries to re-request from MAL per hour, see app/refresh_schedule.py
+    REFRESH_BUDGET_PER_HOUR: int = 60
+    # how many summaries update_database reads ahead of the entry it's writing, see app/prefetch.py
+    PREFETCH_WINDOW: int = 32
+    # /changes/stream, see app/change_stream.py
+    STREAM_BUFFER_SIZE: int = 1000
+    STREAM_POLL_INTERVAL: float = 2.0
+    STREAM_KEEPALIVE: float = 15.0
 
     class Config:
         case_sensitive = True
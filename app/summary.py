@@ -7,10 +7,11 @@ from sqlalchemy import func
 from pydantic import BaseModel, root_validator
 
 from app.db import (
-    get_db,
+    get_read_db,
     AnimeMetadata,
     MangaMetadata,
 )
+from app.executors import run_db
 
 router = APIRouter()
 
@@ -31,8 +32,7 @@ class MetadataCountOut(BaseModel):
     manga: List[Status]
 
 
-@router.get("/", response_model=MetadataCountOut)
-async def get_metadata_counts(db: Session = Depends(get_db)) -> MetadataCountOut:
+def _metadata_counts(db: Session) -> MetadataCountOut:
     anime_status_counts = db.exec(
         select(AnimeMetadata.approved_status, func.count(AnimeMetadata.approved_status))  # type: ignore[call-overload]
         .group_by(AnimeMetadata.approved_status)
@@ -47,3 +47,8 @@ async def get_metadata_counts(db: Session = Depends(get_db)) -> MetadataCountOut
         anime=anime_status_counts,
         manga=manga_status_counts,
     )
+
+
+@router.get("/", response_model=MetadataCountOut)
+async def get_metadata_counts(db: Session = Depends(get_read_db)) -> MetadataCountOut:
+    return await run_db(_metadata_counts, db)
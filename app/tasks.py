@@ -12,7 +12,9 @@ from app.db import (
     data_engine,
     AnimeMetadata,
     MangaMetadata,
+    reload_if_replaced,
 )
+from app.executors import run_db, run_network
 
 router = APIRouter()
 
@@ -52,7 +54,8 @@ async def refresh_entry(
     from app.db_entry_update import refresh_entry as refresh
 
     logger.info(f"refreshing {entry_type} {entry_id}")
-    if not _has_data(entry_type, entry_id):
+    reload_if_replaced()
+    if not await run_network(_has_data, entry_type, entry_id):
         logger.error(f"no data for {entry_type} {entry_id}, can't refresh")
         response.status_code = 400
         return Error(error="That id does not have any data saved, can't refresh")
@@ -63,7 +66,7 @@ async def refresh_entry(
     )
     try:
         response.status_code = 200
-        return _fetch_data(entry_type, entry_id)
+        return await run_db(_fetch_data, entry_type, entry_id)
     except ValueError as ve:
         response.status_code = 404
         return Error(error=str(ve))
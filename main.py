@@ -1,22 +1,17 @@
+import os
 import sys
 import json
 import logging
 import asyncio
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Sequence
 
 import click
 
-from mal_id.metadata_cache import request_metadata, has_metadata
-from mal_id.linear_history import track_diffs, iter_linear_history
-from mal_id.ids import (
-    unapproved_ids,
-    estimate_all_users_max,
-    _estimate_page,
-    approved_ids,
-)
-from mal_id.index_requests import request_pages, currently_requesting, queue
+# everything else is imported in the commands which use it, so cron jobs
+# running the cheap commands don't pay for importing the rest
 from mal_id.paths import (
+    data_dir,
     linear_history_unmerged,
     linear_history_cleaned,
     my_animelist_xml,
@@ -41,6 +36,8 @@ def mal() -> None:
 @mal.command(short_help="create timeline using git history")
 def linear_history() -> None:
     """Create a big json file with dates based on the git timestamps for when entries were added to cache"""
+    from mal_id.linear_history import track_diffs
+
     for d in track_diffs():
         print(json.dumps(d.to_dict()))
 
@@ -104,7 +101,13 @@ def update_metadata(request_failed: bool, print_missing: bool) -> None:
     """
     request missing entry metadata using MAL API
     """
-    from mal_id.metadata_cache import check_mal as heartbeat
+    from mal_id.metadata_cache import (
+        check_mal as heartbeat,
+        request_metadata,
+        has_metadata,
+    )
+    from mal_id.linear_history import iter_linear_history
+    from mal_id.ids import unapproved_ids
 
     total_missing = 0
 
@@ -137,12 +140,46 @@ def update_metadata(request_failed: bool, print_missing: bool) -> None:
         click.echo(f"total missing: {total_missing}")
 
 
+@mal.command(short_help="classify everything in the metadata cache")
+@click.option("--workers", type=int, default=4, show_default=True)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=data_dir / "cache_health",
+    show_default=True,
+    help="where to write report.json and rerequest.txt",
+)
+@click.option(
+    "--rerequest", is_flag=True, help="re-request the broken entries after scanning"
+)
+def cache_health(workers: int, output_dir: Path, rerequest: bool) -> None:
+    """
+    scans the metadata cache for 404s and any summaries saved while MAL
+    was down/under maintenance, and writes a report and re-request queue
+    """
+    from mal_id.cache_health import scan_cache, write_report
+    from mal_id.paths import metadatacache_dir
+
+    results = scan_cache(metadatacache_dir / "data", workers=workers)
+    counts = write_report(results, output_dir)
+    for health, count in sorted(counts.items()):
+        click.echo(f"{health}: {count}")
+
+    if rerequest:
+        from mal_id.metadata_cache import request_metadata
+        from app.db_entry_update import mal_url_to_parts
+
+        for url in (output_dir / "rerequest.txt").read_text().splitlines():
+            entry_type, entry_id = mal_url_to_parts(url)
+            request_metadata(entry_id, entry_type, force_rerequest=True)
+
+
 @mal.command(short_help="run a full db update")
 @click.option(
     "--rerequest-oldest",
     type=int,
     default=None,
-    help="rerequest and update data for oldest N entries",
+    help="rerequest and update data for up to N expired entries, stalest/most popular first (capped by REFRESH_BUDGET_PER_HOUR)",
 )
 def full_db_update(rerequest_oldest: Optional[int]) -> None:
     """
@@ -167,6 +204,8 @@ def pages() -> None:
     """
     print page ranges from indexer
     """
+    from mal_id.index_requests import currently_requesting, queue
+
     click.echo("currently requesting: {}".format(currently_requesting()))
     click.echo("queue: {}".format(queue()))
 
@@ -178,6 +217,8 @@ def _request_pages(
     request: bool,
     timid: bool,
 ) -> None:
+    from mal_id.index_requests import request_pages, currently_requesting
+
     if check_pages == 0:
         click.echo("no new entries found, skipping request", err=True)
         return
@@ -210,10 +251,24 @@ def _request_pages(
     default=False,
     help="print corresponding checker_mal url query params",
 )
+@click.option(
+    "--workers",
+    type=int,
+    default=4,
+    show_default=True,
+    help="number of user lists to request at once",
+)
 @click.argument("USERNAMES", type=click.Path(exists=True))
 def estimate_user_recent(
-    usernames: str, request: bool, timid: bool, list_type: str, print_url: bool
+    usernames: str,
+    request: bool,
+    timid: bool,
+    list_type: str,
+    print_url: bool,
+    workers: int,
 ) -> None:
+    from mal_id.ids import estimate_all_users_max
+
     check_usernames = list(
         filter(
             lambda ln: ln.strip(),
@@ -221,7 +276,7 @@ def estimate_user_recent(
         )
     )
     assert len(check_usernames) > 0
-    check_pages = estimate_all_users_max(check_usernames, list_type)
+    check_pages = estimate_all_users_max(check_usernames, list_type, workers=workers)
 
     if print_url and check_pages > 0:
         click.echo(f"type={list_type}&pages={check_pages}")
@@ -236,10 +291,17 @@ def estimate_user_recent(
 @click.option(
     "--timid", is_flag=True, help="only request new entries if not already requesting"
 )
-def estimate_deleted_animelist_xml(request: bool, timid: bool) -> None:
+@click.option(
+    "--workers",
+    type=int,
+    default=4,
+    show_default=True,
+    help="number of entries to probe at once",
+)
+def estimate_deleted_animelist_xml(request: bool, timid: bool, workers: int) -> None:
     from mal_id.ids import estimate_deleted_entry
 
-    check_pages = estimate_deleted_entry(my_animelist_xml)
+    check_pages = estimate_deleted_entry(my_animelist_xml, workers=workers)
     _request_pages(
         check_pages=check_pages, list_type="anime", request=request, timid=timid
     )
@@ -253,13 +315,16 @@ def estimate_deleted_animelist_xml(request: bool, timid: bool) -> None:
     required=True,
     default="anime",
 )
-@click.argument("MAL_ID", type=int)
-def estimate_page(entry_type: str, mal_id: int) -> None:
-    click.echo(
-        _estimate_page(
-            mal_id, list(reversed(sorted(getattr(approved_ids(), entry_type))))
-        )
-    )
+@click.argument("MAL_ID", type=int, nargs=-1, required=True)
+def estimate_page(entry_type: str, mal_id: Sequence[int]) -> None:
+    from mal_id.ids import approved_ids
+
+    index = approved_ids().for_type(entry_type).page_index
+    if len(mal_id) == 1:
+        click.echo(index.page(mal_id[0]))
+    else:
+        for mid, page in zip(mal_id, index.pages(mal_id)):
+            click.echo(f"{mid} {page}")
 
 
 @main.group("dbs", short_help="for interacting with other dbs")
@@ -284,21 +349,32 @@ def anilist_update(only: str) -> None:
     approved = approved_ids()
 
     if only is None or only == "anime":
-        for mal_id in approved.anime:
-            ac.get("https://myanimelist.net/anime/{}".format(mal_id))
+        ac.get_many("anime", approved.anime_list)
 
     if only is None or only == "manga":
-        for mal_id in approved.manga:
-            ac.get("https://myanimelist.net/manga/{}".format(mal_id))
+        ac.get_many("manga", approved.manga_list)
+
+
+@dbs.command(short_help="sync anilist ids into the database")
+def anilist_sync() -> None:
+    """
+    bulk upsert the anilist ids from ARM and the anilist cache into
+    the database. run anilist-update first to request any missing ones
+    """
+    from app.anilist_ids import sync_anilist_ids
+
+    click.echo(f"synced {sync_anilist_ids()} anilist ids")
 
 
 @dbs.command(short_help="print syobocal urls which have MAL urls")
 def dump_syobocal() -> None:
-    from mal_id.arm import mal_arm_dict
+    from mal_id.arm import arm_index, SYOBOCAL_URL
 
-    for mal_id, arm_obj in mal_arm_dict().items():
-        if arm_obj.syobocal_tid is not None:
-            click.echo(f"{mal_id} => {arm_obj.syobocal_url}")
+    index = arm_index()
+    # if a MAL id is on more than one row, the last one wins (like mal_arm_dict)
+    for mal_id in index.rows["mal_id"]:
+        if (tid := index.convert("mal_id", mal_id, "syobocal_tid")) is not None:
+            click.echo(f"{mal_id} => {SYOBOCAL_URL.format(tid=tid)}")
 
 
 @main.group()
@@ -325,14 +401,61 @@ def server() -> None:
     default=False,
     help="skip proxying images to S3",
 )
+@click.option(
+    "--sharded",
+    is_flag=True,
+    default=False,
+    help="rebuild from the metadata cache using multiple processes, and swap it in",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=os.cpu_count() or 4,
+    show_default=True,
+    help="processes to use with --sharded",
+)
+@click.option(
+    "--shard-size",
+    type=int,
+    default=2000,
+    show_default=True,
+    help="entries per shard with --sharded",
+)
+@click.option(
+    "--min-ratio",
+    type=float,
+    default=0.95,
+    show_default=True,
+    help="with --sharded, dont swap in the new database if it has less than this ratio of the current rows",
+)
 def initialize_db(
-    refresh_images: bool, force_update_db: bool, skip_proxy_images: bool
+    refresh_images: bool,
+    force_update_db: bool,
+    skip_proxy_images: bool,
+    sharded: bool,
+    workers: int,
+    shard_size: int,
+    min_ratio: float,
 ) -> None:
-    """initialize database"""
+    """
+    initialize database
+
+    --sharded builds into a shadow file, checks it, and then replaces the entry
+    tables in the current database with its rows in one write transaction, so
+    the server can keep running. It doesn't request
+    anything from MAL or proxy images, so run 'mal update-metadata' before,
+    and a normal update after to add images
+    """
     from app.db import init_db
     from app.db_entry_update import update_database
     from asyncio import run
 
+    if sharded:
+        from app.rebuild import rebuild_database
+
+        rebuild_database(workers=workers, shard_size=shard_size, min_ratio=min_ratio)
+        return
+
     init_db()
     run(
         update_database(
@@ -377,5 +500,34 @@ def delete_database() -> None:
         click.echo("Database doesn't exist...")
 
 
+# what the commands cron runs every minute (pages, check-mal) import
+CHEAP_COMMAND_IMPORTS = ["main", "mal_id.index_requests", "mal_id.metadata_cache"]
+IMPORT_BUDGET_SECONDS = 1.0
+
+
+def test_import_budget() -> None:
+    import subprocess
+
+    # in a new interpreter, since pytest already imported most of these
+    code = f"""
+import sys, time
+start = time.perf_counter()
+for mod in {CHEAP_COMMAND_IMPORTS!r}:
+    __import__(mod)
+print(time.perf_counter() - start)
+for mod in ("git", "boto3", "sqlmodel", "malexport.exporter"):
+    assert mod not in sys.modules, f"{{mod}} was imported"
+"""
+    proc = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+    )
+    assert proc.returncode == 0, proc.stderr
+    took = float(proc.stdout.strip())
+    assert took < IMPORT_BUDGET_SECONDS, f"importing took {took:.2f}s"
+
+
 if __name__ == "__main__":
     main(prog_name="generate_history")
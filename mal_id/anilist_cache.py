@@ -1,17 +1,141 @@
+import os
 import logging
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Dict, Any
+from threading import Lock
+from typing import Optional, Dict, Any, Iterable, List
 from functools import cache
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from more_itertools import chunked
 
 from mal_id.log import logger
 from mal_id.paths import anilist_cache as cpath
 from url_cache.core import URLCache, Summary
 
-GRAPHQL_URL = "https://graphql.anilist.co"
+GRAPHQL_URL = os.environ.get("DBSENTINEL_ANILIST_URL", "https://graphql.anilist.co")
+
+# the most media anilist returns in one page
+BATCH_SIZE = 50
+
+MEDIA_FIELDS = """
+    id
+    idMal
+    type
+    status
+    title {
+        romaji
+        english
+        native
+    }
+    genres
+    tags {
+        id
+        name
+        description
+        category
+        rank
+        isGeneralSpoiler
+        isMediaSpoiler
+        isAdult
+    }
+    seasonYear
+    season
+    format
+    isAdult
+    countryOfOrigin
+    isLicensed
+    source
+    externalLinks {
+        id
+        url
+        site
+        siteId
+        type
+        language
+        notes
+        isDisabled
+    }
+"""
+# islicensed describes whether its official licensed or doujin work
+
+
+class AnilistRateLimiter:
+    """
+    waits based on the X-RateLimit-Remaining/X-RateLimit-Reset headers from
+    the last response, instead of sleeping a fixed amount between requests
+
+    shared between threads, requests only wait if the remaining budget
+    from the last response has run out. Once it has, every caller waits
+    until the reset time, not just the first one to notice
+    """
+
+    def __init__(self, min_remaining: int = 1) -> None:
+        self.min_remaining = min_remaining
+        self._lock = Lock()
+        self._remaining: Optional[int] = None
+        self._reset_at: Optional[float] = None
+
+    def wait(self) -> None:
+        with self._lock:
+            if (
+                self._remaining is None
+                or self._reset_at is None
+                or self._remaining > self.min_remaining
+            ):
+                if self._remaining is not None:
+                    self._remaining -= 1
+                return
+            wait_for = self._reset_at - time.time()
+        if wait_for > 0:
+            logger.info(f"Anilist rate limit reached, waiting {wait_for:.1f}s")
+            time.sleep(wait_for)
+
+    def update(self, response: requests.Response) -> None:
+        with self._lock:
+            if "X-RateLimit-Reset" in response.headers:
+                self._reset_at = float(response.headers["X-RateLimit-Reset"])
+                if "X-RateLimit-Remaining" in response.headers:
+                    self._remaining = int(response.headers["X-RateLimit-Remaining"])
+                return
+            if (
+                self._remaining is not None
+                and self._remaining <= self.min_remaining
+                and self._reset_at is not None
+                and time.time() < self._reset_at
+            ):
+                # the budget ran out, responses to requests sent before that
+                # dont raise it again until the reset time has passed
+                return
+            if "X-RateLimit-Remaining" in response.headers:
+                self._remaining = int(response.headers["X-RateLimit-Remaining"])
+            if self._remaining is not None and self._remaining <= self.min_remaining:
+                # anilist only sends the reset time once it returns a 429,
+                # the limit is per minute so this is the latest it could be
+                self._reset_at = time.time() + 60
+
+
+anilist_limiter = AnilistRateLimiter()
+
+
+def _post(query: str, variables: Dict[str, Any]) -> requests.Response:
+    """
+    sends a graphql request, waiting for anilist's rate limit.
+    if it responds with a 429, waits for the Retry-After and retries
+    """
+    while True:
+        anilist_limiter.wait()
+        response = requests.post(
+            GRAPHQL_URL, json={"query": query, "variables": variables}
+        )
+        anilist_limiter.update(response)
+        if response.status_code != 429:
+            return response
+        retry_after = int(response.headers.get("Retry-After", 60))
+        logger.warning(f"Anilist returned 429, retrying after {retry_after}s")
+        time.sleep(retry_after)
 
 
 class AnilistCache(URLCache):
@@ -26,60 +150,63 @@ class AnilistCache(URLCache):
 
     @staticmethod
     def fetch_anilist_data(mal_id: int, media_type: str) -> Optional[Dict[str, Any]]:
-        query = """query($id: Int, $type: MediaType){Media(idMal: $id, type: $type){
-            id
-            idMal
-            type
-            status
-            title {
-                romaji
-                english
-                native
-            }
-            genres
-            tags {
-                id
-                name
-                description
-                category
-                rank
-                isGeneralSpoiler
-                isMediaSpoiler
-                isAdult
-            }
-            seasonYear
-            season
-            format
-            isAdult
-            countryOfOrigin
-            isLicensed
-            source
-            externalLinks {
-                id
-                url
-                site
-                siteId
-                type
-                language
-                notes
-                isDisabled
-            }
-        }}"""
-        # islicensed describes whether its official licensed or doujin work
+        query = (
+            "query($id: Int, $type: MediaType){Media(idMal: $id, type: $type){"
+            + MEDIA_FIELDS
+            + "}}"
+        )
         mtype = media_type.upper()
         assert mtype in ("ANIME", "MANGA")
         variables = {"id": mal_id, "type": mtype}
-        time.sleep(1)
         logger.info(f"Requesting Anilist ID for {mtype} {mal_id}")
-        response = requests.post(
-            GRAPHQL_URL, json={"query": query, "variables": variables}
-        )
+        response = _post(query, variables)
         if response.status_code > 400 and response.status_code < 500:
             logger.warning(f"Anilist returned {response.status_code}, not found")
             return None
         data: Dict[str, Any] = response.json()["data"]["Media"]
         return data
 
+    @staticmethod
+    def fetch_anilist_many(
+        mal_ids: List[int], media_type: str
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        requests up to BATCH_SIZE MAL ids at a time, returns a dict
+        of MAL id to the anilist data. IDs anilist doesn't have are missing
+
+        more than one anilist entry can have the same MAL id, so this
+        can be more than one page of results
+        """
+        assert len(mal_ids) <= BATCH_SIZE
+        query = (
+            "query($ids: [Int], $type: MediaType, $page: Int, $perPage: Int){"
+            + "Page(page: $page, perPage: $perPage){pageInfo{hasNextPage} "
+            + "media(idMal_in: $ids, type: $type){"
+            + MEDIA_FIELDS
+            + "}}}"
+        )
+        mtype = media_type.upper()
+        assert mtype in ("ANIME", "MANGA")
+        logger.info(f"Requesting Anilist IDs for {len(mal_ids)} {mtype}")
+        found: Dict[int, Dict[str, Any]] = {}
+        page = 1
+        while True:
+            variables = {
+                "ids": mal_ids,
+                "type": mtype,
+                "page": page,
+                "perPage": BATCH_SIZE,
+            }
+            response = _post(query, variables)
+            response.raise_for_status()
+            data = response.json()["data"]["Page"]
+            for media in data["media"]:
+                # if more than one anilist entry has this MAL id, keep the first
+                found.setdefault(media["idMal"], media)
+            if not data["pageInfo"]["hasNextPage"]:
+                return found
+            page += 1
+
     @staticmethod
     def is_404(summary: Summary | None) -> bool:
         if summary is None:
@@ -88,15 +215,8 @@ class AnilistCache(URLCache):
             return bool(summary.metadata["error"] == 404)
         return False
 
-    def request_data(self, url: str, preprocess_url: bool = True) -> Summary:
-        if preprocess_url:
-            uurl = self.preprocess_url(url)
-        else:
-            uurl = url
-        del url
-        mal_id = int(uurl.split("/")[-1])
-        media_type = uurl.split("/")[-2]
-        anilist_data = self.fetch_anilist_data(mal_id, media_type)
+    @staticmethod
+    def _summary(uurl: str, anilist_data: Optional[Dict[str, Any]]) -> Summary:
         if anilist_data is None:
             return Summary(
                 url=uurl,
@@ -108,6 +228,69 @@ class AnilistCache(URLCache):
             url=uurl, data={}, metadata=anilist_data, timestamp=datetime.now()
         )
 
+    def request_data(self, url: str, preprocess_url: bool = True) -> Summary:
+        if preprocess_url:
+            uurl = self.preprocess_url(url)
+        else:
+            uurl = url
+        del url
+        mal_id = int(uurl.split("/")[-1])
+        media_type = uurl.split("/")[-2]
+        return self._summary(uurl, self.fetch_anilist_data(mal_id, media_type))
+
+    def _needs_request(self, uurl: str) -> bool:
+        if not self.in_cache(uurl):
+            return True
+        if self.expiry_duration is None:
+            return False
+        summary = self.summary_cache.get(uurl)
+        return (
+            summary is None
+            or summary.timestamp is None
+            or datetime.now() - summary.timestamp > self.expiry_duration
+        )
+
+    def get_many(
+        self, media_type: str, mal_ids: Iterable[int], workers: int = 2
+    ) -> None:
+        """
+        caches lots of entries at once. any which aren't cached (or have expired)
+        are requested BATCH_SIZE at a time, from 'workers' threads
+
+        doesn't return the summaries, use get to read them from the cache
+        """
+        assert media_type in ("anime", "manga")
+        urls = {
+            mal_id: self.preprocess_url(
+                f"https://myanimelist.net/{media_type}/{mal_id}"
+            )
+            for mal_id in mal_ids
+        }
+        missing = [mal_id for mal_id, uurl in urls.items() if self._needs_request(uurl)]
+        logger.info(
+            f"Anilist {media_type}: {len(urls) - len(missing)} cached, requesting {len(missing)}"
+        )
+
+        def _fetch_batch(batch: List[int]) -> None:
+            try:
+                found = self.fetch_anilist_many(batch, media_type)
+            except requests.HTTPError as e:
+                # dont cache anything for this batch, the next run retries it
+                if e.response is not None and 400 <= e.response.status_code < 500:
+                    logger.warning(
+                        f"Anilist returned {e.response.status_code} for {media_type} {batch[0]}..{batch[-1]}, skipping batch"
+                    )
+                    return
+                raise
+            for mal_id in batch:
+                self.summary_cache.put(
+                    urls[mal_id], self._summary(urls[mal_id], found.get(mal_id))
+                )
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list to raise any errors from the threads
+            list(pool.map(_fetch_batch, chunked(missing, BATCH_SIZE)))
+
     def refresh_data(self, url: str) -> Summary:
         uurl = self.preprocess_url(url)
         summary = self.request_data(uurl, preprocess_url=False)
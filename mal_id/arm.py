@@ -1,10 +1,15 @@
+from array import array
+from pathlib import Path
+from functools import lru_cache
+from typing import Dict, Iterator, Optional, Tuple
+
 import orjson
 from mal_id.paths import arm_dir
 from pydantic import BaseModel
 
-
 arm_file = (arm_dir / "arm.json").absolute()
-assert arm_file.exists()
+
+SYOBOCAL_URL = "https://cal.syoboi.jp/tid/{tid}"
 
 
 class Arm(BaseModel):
@@ -15,16 +20,105 @@ class Arm(BaseModel):
 
     @property
     def syobocal_url(self) -> str:
-        return f"https://cal.syoboi.jp/tid/{self.syobocal_tid}"
+        return SYOBOCAL_URL.format(tid=self.syobocal_tid)
+
+
+COLUMNS = ("mal_id", "anilist_id", "annict_id", "syobocal_tid")
+
+# ids are all positive, so this marks a missing one in the arrays
+MISSING = 0
+
+
+class ArmIndex:
+    """
+    the ARM mapping as one int array per column (MISSING if a row doesn't have
+    that id), plus a dict for each column from id to row, to convert in any direction
+    """
+
+    def __init__(self, rows: list[dict[str, int | None]]) -> None:
+        self.columns: Dict[str, array[int]] = {
+            col: array("i", (row.get(col) or MISSING for row in rows))
+            for col in COLUMNS
+        }
+        self.rows: Dict[str, Dict[int, int]] = {
+            col: {val: i for i, val in enumerate(self.columns[col]) if val != MISSING}
+            for col in COLUMNS
+        }
+
+    def __len__(self) -> int:
+        return len(self.columns["mal_id"])
+
+    def _value(self, col: str, row: int) -> Optional[int]:
+        val = self.columns[col][row]
+        return None if val == MISSING else val
+
+    def arm(self, row: int) -> Arm:
+        # the data was already checked when it was loaded, so skip validation
+        return Arm.construct(
+            mal_id=self._value("mal_id", row),
+            anilist_id=self._value("anilist_id", row),
+            annict_id=self._value("annict_id", row),
+            syobocal_tid=self._value("syobocal_tid", row),
+        )
+
+    def get(self, col: str, val: int) -> Optional[Arm]:
+        row = self.rows[col].get(val)
+        return None if row is None else self.arm(row)
+
+    def convert(self, from_col: str, val: int, to_col: str) -> Optional[int]:
+        """e.g. convert('mal_id', 1, 'anilist_id')"""
+        row = self.rows[from_col].get(val)
+        return None if row is None else self._value(to_col, row)
+
+    def pairs(self, from_col: str, to_col: str) -> Iterator[Tuple[int, int]]:
+        """every row which has both ids"""
+        for a, b in zip(self.columns[from_col], self.columns[to_col]):
+            if a != MISSING and b != MISSING:
+                yield a, b
+
+
+@lru_cache(maxsize=1)
+def _read_arm_index(path: Path, mtime_ns: int) -> ArmIndex:
+    rows = orjson.loads(path.read_bytes())
+    return ArmIndex(
+        [
+            {col: None if row.get(col) is None else int(row[col]) for col in COLUMNS}
+            for row in rows
+        ]
+    )
+
+
+def arm_index() -> ArmIndex:
+    """reads arm.json, or from memory if the mtime hasn't changed"""
+    assert arm_file.exists(), f"{arm_file} doesn't exist"
+    return _read_arm_index(arm_file, arm_file.stat().st_mtime_ns)
 
 
 def arm_dump(filter_mal_id: bool = True) -> list[Arm]:
-    data = orjson.loads(arm_file.read_bytes())
-    objs = [Arm.parse_obj(v) for v in data]
+    index = arm_index()
     if filter_mal_id:
-        objs = [v for v in objs if v.mal_id is not None]
-    return objs
+        return [index.arm(row) for row in index.rows["mal_id"].values()]
+    return [index.arm(row) for row in range(len(index))]
 
 
 def mal_arm_dict() -> dict[int, Arm]:
-    return {v.mal_id: v for v in arm_dump(filter_mal_id=True) if v.mal_id is not None}
+    index = arm_index()
+    return {mal_id: index.arm(row) for mal_id, row in index.rows["mal_id"].items()}
+
+
+def test_arm_index() -> None:
+    index = ArmIndex(
+        [
+            {"mal_id": 1, "anilist_id": 10, "annict_id": None, "syobocal_tid": 100},
+            {"mal_id": None, "anilist_id": 20, "annict_id": 5, "syobocal_tid": None},
+        ]
+    )
+    assert index.convert("mal_id", 1, "anilist_id") == 10
+    assert index.convert("anilist_id", 20, "annict_id") == 5
+    assert index.convert("syobocal_tid", 100, "mal_id") == 1
+    assert index.convert("anilist_id", 20, "mal_id") is None
+    assert index.get("mal_id", 2) is None
+    assert index.get("annict_id", 5) == Arm(
+        mal_id=None, anilist_id=20, annict_id=5, syobocal_tid=None
+    )
+    assert list(index.pairs("mal_id", "syobocal_tid")) == [(1, 100)]
@@ -0,0 +1,159 @@
+"""
+Classifies the summaries saved in the metadata cache, and scans the whole
+cache (in parallel) to find any which should be re-requested
+
+This doesn't import the MetadataCache, so the process pool workers
+don't need to authenticate with the MAL API
+"""
+
+import enum
+from pathlib import Path
+from datetime import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import orjson
+from url_cache.model import Summary
+
+from mal_id.log import logger
+
+
+class SummaryHealth(str, enum.Enum):
+    OK = "ok"
+    NOT_FOUND = "404"
+    # 504 (or 429) from the MAL API, when MAL is down
+    MAL_DOWN = "504"
+    MAINTENANCE = "maintenance"
+    # the {'id': -1, 'title': 'Title', ...} response MAL sometimes returns when its down
+    BROKEN_ID = "broken_id"
+    # some other http error that was saved
+    ERROR = "error"
+
+
+# these were saved while MAL was having issues, and should be re-requested
+BROKEN = {SummaryHealth.MAL_DOWN, SummaryHealth.MAINTENANCE, SummaryHealth.BROKEN_ID}
+
+BROKEN_SHAPE_KEYS = {
+    "id",
+    "title",
+    "num_chapters",
+    "status",
+    "num_episodes",
+    "media_type",
+}
+
+
+def classify_metadata(metadata: Dict[str, Any]) -> SummaryHealth:
+    if "error" in metadata:
+        if metadata["error"] in {429, 504}:  # 429 probably has never happened
+            return SummaryHealth.MAL_DOWN
+        if metadata["error"] == 404:
+            return SummaryHealth.NOT_FOUND
+        return SummaryHealth.ERROR
+    if "currently under maintenance" in metadata.get("message", "").lower():
+        return SummaryHealth.MAINTENANCE
+    if metadata.get("id") in {-1, 0}:
+        return SummaryHealth.BROKEN_ID
+    # this is a sort of broken response that MAL returns sometimes when its down
+    # {'id': -1, 'title': 'Title', 'num_chapters': 0, 'status': 'currently_publishing', 'media_type': 'manga'}
+    if (
+        set(metadata.keys()).issubset(BROKEN_SHAPE_KEYS)
+        and (metadata.get("num_episodes") == 0 or metadata.get("num_chapters") == 0)
+        and metadata.get("title", "").lower() in {"title", "", "blocked.", "blocked"}
+    ):
+        return SummaryHealth.BROKEN_ID
+    return SummaryHealth.OK
+
+
+# a summary is only rewritten when its requested again, which changes the timestamp
+# so the classification can be cached by (url, timestamp)
+_CLASSIFIED: Dict[Tuple[str, Optional[datetime]], SummaryHealth] = {}
+CLASSIFIED_MAX_SIZE = 100_000
+
+
+def classify_summary(summary: Summary) -> SummaryHealth:
+    key = (summary.url, summary.timestamp)
+    if (health := _CLASSIFIED.get(key)) is not None:
+        return health
+    health = classify_metadata(summary.metadata)
+    if len(_CLASSIFIED) >= CLASSIFIED_MAX_SIZE:
+        _CLASSIFIED.clear()
+    _CLASSIFIED[key] = health
+    return health
+
+
+class ScanResult(NamedTuple):
+    url: str
+    health: SummaryHealth
+    timestamp: Optional[int]
+
+
+def _scan_entry(keydir: Path) -> Optional[ScanResult]:
+    """reads the key/metadata/timestamp files directly, instead of the whole Summary"""
+    keyfile = keydir / "key"
+    metadata_file = keydir / "metadata.json"
+    if not keyfile.exists() or not metadata_file.exists():
+        return None
+    timestamp_file = keydir / "timestamp.datetime.txt"
+    timestamp = int(timestamp_file.read_text()) if timestamp_file.exists() else None
+    return ScanResult(
+        url=keyfile.read_text().strip(),
+        health=classify_metadata(orjson.loads(metadata_file.read_bytes())),
+        timestamp=timestamp,
+    )
+
+
+def scan_cache(data_dir: Path, workers: int = 4) -> List[ScanResult]:
+    keydirs = [keyfile.parent for keyfile in data_dir.rglob("*/key")]
+    logger.info(f"scanning {len(keydirs)} cached summaries with {workers} processes")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_scan_entry, keydirs, chunksize=256)
+        return [r for r in results if r is not None]
+
+
+def write_report(results: List[ScanResult], output_dir: Path) -> Dict[str, int]:
+    """
+    writes report.json (counts per classification, and the broken urls)
+    and rerequest.txt (the urls of broken summaries, one per line)
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    counts = Counter(r.health.value for r in results)
+    broken = sorted(
+        (r for r in results if r.health in BROKEN), key=lambda r: r.timestamp or 0
+    )
+    (output_dir / "report.json").write_bytes(
+        orjson.dumps(
+            {
+                "total": len(results),
+                "counts": dict(counts),
+                "broken": [
+                    {"url": r.url, "health": r.health.value, "timestamp": r.timestamp}
+                    for r in broken
+                ],
+            },
+            option=orjson.OPT_INDENT_2,
+        )
+    )
+    (output_dir / "rerequest.txt").write_text("".join(f"{r.url}\n" for r in broken))
+    return dict(counts)
+
+
+def test_classify_metadata() -> None:
+    assert classify_metadata({"id": 1, "title": "Cowboy Bebop"}) == SummaryHealth.OK
+    assert classify_metadata({"error": 404}) == SummaryHealth.NOT_FOUND
+    assert classify_metadata({"error": 504}) == SummaryHealth.MAL_DOWN
+    assert classify_metadata({"error": 400}) == SummaryHealth.ERROR
+    assert (
+        classify_metadata({"message": "MAL is currently under maintenance"})
+        == SummaryHealth.MAINTENANCE
+    )
+    assert (
+        classify_metadata(
+            {"id": 5, "title": "Title", "num_chapters": 0, "media_type": "manga"}
+        )
+        == SummaryHealth.BROKEN_ID
+    )
+    assert (
+        classify_metadata({"id": -1, "title": "Something"}) == SummaryHealth.BROKEN_ID
+    )
@@ -1,3 +1,5 @@
+import time
+import threading
 from typing import Any
 from datetime import datetime, timezone
 
@@ -15,3 +17,38 @@ def backoff_handler(details: Any) -> None:
     logger.warning(
         f"backing off after {details.get('tries', '???')} tries, waiting {details.get('wait', '???')}"
     )
+
+
+class RateLimiter:
+    """
+    spaces out calls by at least 'interval' seconds, shared across threads
+
+    each caller reserves the next free slot while holding the lock,
+    then sleeps outside of it until that slot
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self) -> float:
+        """blocks until this caller is allowed to make a request, returns the time waited"""
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_at)
+            self._next_at = at + self.interval
+        if (waited := at - now) > 0:
+            time.sleep(waited)
+        return waited
+
+
+def test_rate_limiter() -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    limiter = RateLimiter(0.05)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: limiter.wait(), range(5)))
+    # first call goes through immediately, the other 4 are spaced out
+    assert time.monotonic() - start >= 0.2
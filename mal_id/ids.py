@@ -1,34 +1,123 @@
+import os
 import time
+from array import array
+from bisect import bisect_left, bisect_right
 from pathlib import Path
-from functools import lru_cache
-from typing import NamedTuple, Set, List, Any
+from functools import lru_cache, cached_property
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import (
+    NamedTuple,
+    Set,
+    List,
+    Any,
+    Tuple,
+    FrozenSet,
+    Iterator,
+    Dict,
+    Optional,
+    Sequence,
+    Iterable,
+    AbstractSet,
+)
 from datetime import datetime
+from threading import Lock
 
 import requests
 import orjson
 import backoff
 from more_itertools import chunked
-from malexport.exporter.mal_list import BASE_URL
 
-from mal_id.paths import mal_id_cache_dir, unapproved_anime_path, unapproved_manga_path
+from mal_id.paths import (
+    mal_id_cache_dir,
+    unapproved_anime_path,
+    unapproved_manga_path,
+    deleted_probe_cache_path,
+)
 from mal_id.log import logger
-from mal_id.common import backoff_handler
+from mal_id.common import backoff_handler, RateLimiter
 from mal_id.parse_xml import parse_user_ids
 
 
+class ApprovedList:
+    """
+    the approved ids for one entry type, as a sorted int32 array
+
+    the frozenset and PageIndex are only built if something uses them
+    """
+
+    def __init__(self, ids: Iterable[int]) -> None:
+        self.ids = array("i", sorted(ids))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def __contains__(self, mal_id: object) -> bool:
+        if not isinstance(mal_id, int):
+            return False
+        i = bisect_left(self.ids, mal_id)
+        return i < len(self.ids) and self.ids[i] == mal_id
+
+    @cached_property
+    def id_set(self) -> FrozenSet[int]:
+        return frozenset(self.ids)
+
+    @cached_property
+    def page_index(self) -> "PageIndex":
+        return PageIndex(self.ids[::-1])
+
+    def isin(self, ids: Iterable[int]) -> List[bool]:
+        """for each id, whether its approved"""
+        id_set = self.id_set
+        return [i in id_set for i in ids]
+
+    def missing(self, ids: Iterable[int]) -> List[int]:
+        """the ids which aren't approved"""
+        id_set = self.id_set
+        return [i for i in ids if i not in id_set]
+
+    def difference(self, other: AbstractSet[int]) -> List[int]:
+        """the approved ids which aren't in other, in ascending order"""
+        return [i for i in self.ids if i not in other]
+
+
 class Approved(NamedTuple):
-    anime: Set[int]
-    manga: Set[int]
+    anime_list: ApprovedList
+    manga_list: ApprovedList
+
+    @property
+    def anime(self) -> FrozenSet[int]:
+        return self.anime_list.id_set
+
+    @property
+    def manga(self) -> FrozenSet[int]:
+        return self.manga_list.id_set
+
+    def for_type(self, entry_type: str) -> ApprovedList:
+        assert entry_type in {"anime", "manga"}
+        return self.anime_list if entry_type == "anime" else self.manga_list
+
+
+@lru_cache(maxsize=2)
+def _read_approved(path: Path, mtime_ns: int) -> ApprovedList:
+    """
+    Reads the sfw/nsfw ids from a mal-id-cache file,
+    or from memory if the mtime hasn't changed
+    """
+    logger.debug(f"Caching approved ids from {path} in memory")
+    data = orjson.loads(path.read_bytes())
+    return ApprovedList(chain(data["sfw"], data["nsfw"]))
 
 
 def approved_ids() -> Approved:
     anime_file = mal_id_cache_dir / "cache" / "anime_cache.json"
     manga_file = mal_id_cache_dir / "cache" / "manga_cache.json"
-    anime = orjson.loads(anime_file.read_text())
-    manga = orjson.loads(manga_file.read_text())
     return Approved(
-        anime=set(anime["sfw"] + anime["nsfw"]),
-        manga=set(manga["sfw"] + manga["nsfw"]),
+        anime_list=_read_approved(anime_file, anime_file.stat().st_mtime_ns),
+        manga_list=_read_approved(manga_file, manga_file.stat().st_mtime_ns),
     )
 
 
@@ -39,104 +128,343 @@ class Entry(NamedTuple):
     type: str
 
 
+class UnapprovedEntries(NamedTuple):
+    """
+    compact, read-only view of one unapproved list, built once per
+    cache file mtime (see _read_unapproved)
+
+    the fields are parallel tuples (ids[i], names[i], nsfw[i], types[i]
+    describe the same entry) plus a frozenset of the ids for membership
+    checks, so accessing them doesn't copy anything
+    """
+
+    ids: Tuple[int, ...]
+    names: Tuple[str, ...]
+    nsfw: Tuple[bool, ...]
+    types: Tuple[str, ...]
+    id_set: FrozenSet[int]
+
+    @classmethod
+    def from_json(cls, data: List[Any]) -> "UnapprovedEntries":
+        ids = tuple(int(e["id"]) for e in data)
+        return cls(
+            ids=ids,
+            names=tuple(e["name"] for e in data),
+            nsfw=tuple(bool(e["nsfw"]) for e in data),
+            types=tuple(e["type"] for e in data),
+            id_set=frozenset(ids),
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def entry(self, index: int) -> Entry:
+        return Entry(
+            id=self.ids[index],
+            name=self.names[index],
+            nsfw=self.nsfw[index],
+            type=self.types[index],
+        )
+
+    def entries(self) -> Iterator[Entry]:
+        return (self.entry(i) for i in range(len(self.ids)))
+
+
 class Unapproved(NamedTuple):
-    anime_info: List[Entry]
-    manga_info: List[Entry]
+    anime_entries: UnapprovedEntries
+    manga_entries: UnapprovedEntries
 
     @property
-    def anime(self) -> Set[int]:
-        return {info.id for info in self.anime_info}
+    def anime(self) -> FrozenSet[int]:
+        return self.anime_entries.id_set
 
     @property
-    def manga(self) -> Set[int]:
-        return {info.id for info in self.manga_info}
+    def manga(self) -> FrozenSet[int]:
+        return self.manga_entries.id_set
 
+    @property
+    def anime_info(self) -> List[Entry]:
+        return list(self.anime_entries.entries())
 
-UNAPPROVED_API_BASE = "https://sean.fish/mal_unapproved/api/"
-# UNAPPROVED_API_BASE = "http://localhost:4001/mal_unapproved/api/"
+    @property
+    def manga_info(self) -> List[Entry]:
+        return list(self.manga_entries.entries())
+
+
+UNAPPROVED_API_BASE = os.environ.get(
+    "DBSENTINEL_UNAPPROVED_API_BASE", "https://sean.fish/mal_unapproved/api/"
+)
 
 SANITY_CHECK_AMOUNT = 10
 
 
-def _request_unapproved(url: str) -> List[Any]:
+class UnapprovedDelta(NamedTuple):
+    # increases by one for each change, consumers save the last one they processed
+    seq: int
+    added: FrozenSet[int]
+    removed: FrozenSet[int]
+    at: float
+
+
+def _validators_path(cache_filepath: Path) -> Path:
+    return cache_filepath.with_suffix(".validators.json")
+
+
+def _delta_path(cache_filepath: Path) -> Path:
+    return cache_filepath.with_suffix(".delta.jsonl")
+
+
+def _read_deltas(cache_filepath: Path) -> Iterator[UnapprovedDelta]:
+    dpath = _delta_path(cache_filepath)
+    if not dpath.exists():
+        return
+    with dpath.open("rb") as f:
+        for line in f:
+            data = orjson.loads(line)
+            yield UnapprovedDelta(
+                seq=data["seq"],
+                added=frozenset(data["added"]),
+                removed=frozenset(data["removed"]),
+                at=data["at"],
+            )
+
+
+def _read_validators(cache_filepath: Path) -> Dict[str, Any]:
+    """
+    the ETag/Last-Modified headers from the last response and when the server
+    was last checked. if the file is missing, fall back to the cache file mtime
+    """
+    vpath = _validators_path(cache_filepath)
+    if vpath.exists():
+        data: Dict[str, Any] = orjson.loads(vpath.read_bytes())
+        return data
+    if cache_filepath.exists():
+        return {"checked_at": cache_filepath.stat().st_mtime}
+    return {}
+
+
+def _request_unapproved(
+    url: str, validators: Dict[str, Any]
+) -> Tuple[Optional[List[Any]], Dict[str, Any]]:
+    """
+    sends a conditional request using the saved validators
+
+    returns None for the data if the server responded with a 304 (not modified)
+    """
     logger.info("Requesting unapproved: {}".format(url))
-    req = requests.get(url)
+    headers = {"Accept-Encoding": "gzip"}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    req = requests.get(url, headers=headers)
+    if req.status_code == 304:
+        logger.debug(f"Unapproved not modified: {url}")
+        return None, validators
     req.raise_for_status()
+    new_validators = {
+        "etag": req.headers.get("ETag"),
+        "last_modified": req.headers.get("Last-Modified"),
+    }
     data: List[Any] = req.json()
     if len(data) < SANITY_CHECK_AMOUNT:
         raise RuntimeError(
             "Not enough unapproved entries -- server may be starting/down"
         )
     else:
-        return data
+        return data, new_validators
 
 
 REREQUEST_TIME = 60 * 5
 
 
 @lru_cache(maxsize=2)
-def _read_unapproved(path: Path, mtime: int) -> List[Any]:
+def _read_unapproved(path: Path, mtime_ns: int) -> UnapprovedEntries:
     """
     Reads the unapproved anime/manga from the cache file,
     or from memory if the mtime hasn't changed
     """
     logger.debug(
-        f"Caching new unapproved path {path} with updated at {datetime.fromtimestamp(mtime)} in memory"
+        f"Caching new unapproved path {path} with updated at {datetime.fromtimestamp(mtime_ns / 1e9)} in memory"
     )
-    data = orjson.loads(path.read_text())
+    data = orjson.loads(path.read_bytes())
     assert isinstance(data, list), f"unapproved data is not a list: {data}"
-    return data
+    return UnapprovedEntries.from_json(data)
+
+
+def _write_delta(
+    cache_filepath: Path, previous: UnapprovedEntries, data: List[Any]
+) -> None:
+    new_ids = frozenset(int(e["id"]) for e in data)
+    added, removed = new_ids - previous.id_set, previous.id_set - new_ids
+    if not added and not removed:
+        return
+    seq = 1 + max((d.seq for d in _read_deltas(cache_filepath)), default=0)
+    logger.info(
+        f"Unapproved {cache_filepath.stem}: {len(added)} added, {len(removed)} removed (delta {seq})"
+    )
+    line = orjson.dumps(
+        {
+            "seq": seq,
+            "added": sorted(added),
+            "removed": sorted(removed),
+            "at": time.time(),
+        }
+    )
+    # appended, so consumers which run less often than REREQUEST_TIME
+    # still see every change since they last checked
+    with _delta_path(cache_filepath).open("ab") as f:
+        f.write(line + b"\n")
 
 
 def _update_unapproved(
     etype: str, cache_filepath: Path, skip_request: bool
-) -> List[Any]:
+) -> UnapprovedEntries:
     """
     manages requesting/updating the cachefiles for anime/manga
 
-    if the data hasn't changed, this will return the memcached data
-    using the path/mtime as a key in the lru_cache above
+    this sends a conditional request (ETag/Last-Modified) once every
+    REREQUEST_TIME seconds. if the server responds with a 304 or the data
+    is the same, the file isn't rewritten, so this returns the memcached
+    data using the path/mtime as a key in the lru_cache above
     """
     data: List[Any] = []
-    if skip_request:
-        data = []
-        write_data = False
-    else:
+    if not skip_request:
         url = UNAPPROVED_API_BASE + etype
-        data = []
-        write_data = True  # dont want to overwrite/change mtime if there's no new data
+        validators = _read_validators(cache_filepath)
+        resp: Optional[List[Any]] = None
+        checked = False
         if not cache_filepath.exists():
-            data = _request_unapproved(url)
+            resp, validators = _request_unapproved(url, {})
+            checked = True
+        elif validators.get("checked_at", 0) < (time.time() - REREQUEST_TIME):
+            try:
+                logger.debug("Unapproved expired: {}".format(etype))
+                resp, validators = _request_unapproved(url, validators)
+                checked = True
+            except (RuntimeError, requests.exceptions.RequestException) as e:
+                logger.exception(str(e), exc_info=e)
+        if checked:
+            validators["checked_at"] = time.time()
+            _validators_path(cache_filepath).write_bytes(orjson.dumps(validators))
+        data = resp or []
+    # either nothing changed (hasn't been 5 minutes, 304, or the request failed and we should fallback to local file)
+    previous: Optional[UnapprovedEntries] = None
+    if cache_filepath.exists():
+        previous = _read_unapproved(cache_filepath, cache_filepath.stat().st_mtime_ns)
+    if len(data) > 0:
+        assert (
+            len(data) > SANITY_CHECK_AMOUNT
+        ), f"sanity check failed, not enough unapproved entries {data}"
+    if len(data) > 0:
+        encoded = orjson.dumps(data)
+        if previous is None:
+            cache_filepath.write_bytes(encoded)
+        elif encoded != cache_filepath.read_bytes():
+            _write_delta(cache_filepath, previous, data)
+            cache_filepath.write_bytes(encoded)
         else:
-            if cache_filepath.stat().st_mtime < (time.time() - REREQUEST_TIME):
-                try:
-                    logger.debug("Unapproved expired: {}".format(etype))
-                    data = _request_unapproved(url)
-                except (RuntimeError, requests.exceptions.RequestException) as e:
-                    logger.exception(str(e), exc_info=e)
-                    write_data = False
-    # either the data hasn't changed (hasn't been 10 minutes, or the request failed and we should fallback to local file)
-    if len(data) == 0:
-        data = _read_unapproved(cache_filepath, int(cache_filepath.stat().st_mtime))
-        write_data = False
-    assert (
-        len(data) > SANITY_CHECK_AMOUNT
-    ), f"sanity check failed, not enough unapproved entries {data}"
-    if write_data:
-        cache_filepath.write_bytes(orjson.dumps(data))
+            # server didn't send validators/ignored them, but the list is the same
+            logger.debug(f"Unapproved {etype} unchanged, not rewriting")
     else:
         logger.debug(
-            f"Skipped writing unapproved data, request failed or no new data for {etype}"
+            f"Skipped writing unapproved data, request failed or not modified for {etype}"
         )
-    return data
+    entries = _read_unapproved(cache_filepath, cache_filepath.stat().st_mtime_ns)
+    assert (
+        len(entries) > SANITY_CHECK_AMOUNT
+    ), f"sanity check failed, not enough unapproved entries ({len(entries)})"
+    return entries
+
+
+def unapproved_deltas(etype: str, since: int = 0) -> List[UnapprovedDelta]:
+    """
+    the changes to the unapproved list after the 'since' sequence number,
+    oldest first. the list hasn't changed since it was first saved if this is empty
+
+    callers save the seq of the last delta they processed and pass it back
+    the next time, so they only see the ids which changed since then
+    """
+    assert etype in {"anime", "manga"}
+    cache_filepath = (
+        unapproved_anime_path if etype == "anime" else unapproved_manga_path
+    )
+    return [d for d in _read_deltas(cache_filepath) if d.seq > since]
 
 
 def unapproved_ids() -> Unapproved:
     anime = _update_unapproved("anime", unapproved_anime_path, skip_request=False)
     manga = _update_unapproved("manga", unapproved_manga_path, skip_request=False)
-    return Unapproved(
-        anime_info=[Entry(**a) for a in anime], manga_info=[Entry(**m) for m in manga]
-    )
+    return Unapproved(anime_entries=anime, manga_entries=manga)
+
+
+def test_update_unapproved(tmp_path: Path, monkeypatch: Any) -> None:
+    cache_filepath = tmp_path / "anime.json"
+    responses: List[Tuple[Optional[List[Any]], Dict[str, Any]]] = []
+    sent: List[Dict[str, Any]] = []
+
+    def _request(url: str, validators: Dict[str, Any]) -> Any:
+        sent.append(dict(validators))
+        return responses.pop(0)
+
+    monkeypatch.setitem(globals(), "_request_unapproved", _request)
+
+    def _entries(ids: Iterable[int]) -> List[Any]:
+        return [{"id": i, "name": str(i), "nsfw": False, "type": "TV"} for i in ids]
+
+    def _update(
+        resp: Optional[List[Any]], validators: Dict[str, Any]
+    ) -> UnapprovedEntries:
+        responses.append((resp, validators))
+        # pretend REREQUEST_TIME has passed
+        vpath = _validators_path(cache_filepath)
+        if vpath.exists():
+            vpath.write_bytes(
+                orjson.dumps({**_read_validators(cache_filepath), "checked_at": 0})
+            )
+        entries = _update_unapproved("anime", cache_filepath, skip_request=False)
+        assert not responses
+        return entries
+
+    def _bump_mtime(ns: int) -> None:
+        # mtimes can be coarser than these writes, make sure each is seen as new
+        os.utime(cache_filepath, ns=(ns, ns))
+
+    entries = _update(_entries(range(1, 21)), {"etag": "a"})
+    assert sent[-1] == {}
+    assert entries.ids == tuple(range(1, 21))
+    _bump_mtime(1)
+
+    # not checked again until REREQUEST_TIME has passed
+    _update_unapproved("anime", cache_filepath, skip_request=False)
+    assert len(sent) == 1
+
+    # 304
+    _update(None, {"etag": "a", "checked_at": 0})
+    assert sent[-1]["etag"] == "a"
+    assert cache_filepath.stat().st_mtime_ns == 1
+
+    # same body, without a 304
+    _update(_entries(range(1, 21)), {"etag": "b"})
+    assert cache_filepath.stat().st_mtime_ns == 1
+    assert list(_read_deltas(cache_filepath)) == []
+
+    entries = _update(_entries(range(2, 22)), {"etag": "c"})
+    assert sent[-1]["etag"] == "b"
+    _bump_mtime(2)
+    assert entries.ids == tuple(range(2, 22))
+    _update(_entries(range(3, 23)), {"etag": "d"})
+
+    deltas = list(_read_deltas(cache_filepath))
+    assert [(d.seq, d.added, d.removed) for d in deltas] == [
+        (1, frozenset({21}), frozenset({1})),
+        (2, frozenset({22}), frozenset({2})),
+    ]
+
+
+# MAL list requests made by the estimators, shared by all threads
+MAL_LIST_REQUEST_INTERVAL = 2.0
+mal_list_limiter = RateLimiter(MAL_LIST_REQUEST_INTERVAL)
 
 
 @backoff.on_exception(
@@ -146,7 +474,9 @@ def unapproved_ids() -> Unapproved:
     on_backoff=backoff_handler,
 )
 def user_recently_updated(list_type: str, username: str, offset: int) -> Set[int]:
-    time.sleep(5)
+    from malexport.exporter.mal_list import BASE_URL
+
+    mal_list_limiter.wait()
     assert list_type in {"anime", "manga"}
     url = BASE_URL.format(list_type=list_type, username=username, offset=offset)
     req = requests.get(url)
@@ -166,18 +496,86 @@ def user_recently_updated(list_type: str, username: str, offset: int) -> Set[int
     return set([int(entry[key]) for entry in data])
 
 
+class PageIndex:
+    """
+    Looks up which page (of the approved ids sorted in descending order,
+    like the MAL list checker_mal pages through) an id would be on
+
+    stores the smallest id on each page, negated so the array is in
+    ascending order and can be binary searched with bisect
+    """
+
+    def __init__(self, sorted_ids: Sequence[int], page_size: int = 50) -> None:
+        self.page_size = page_size
+        n = len(sorted_ids)
+        self._boundaries = array(
+            "q",
+            (-sorted_ids[min(i + page_size, n) - 1] for i in range(0, n, page_size)),
+        )
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[int], page_size: int = 50) -> "PageIndex":
+        return cls(sorted(ids, reverse=True), page_size=page_size)
+
+    @property
+    def last_page(self) -> int:
+        return len(self._boundaries)
+
+    def page(self, missing_id: int) -> int:
+        """
+        Estimate the page number of a missing (entry which was just approved) entry
+
+        this is the first page whose last (smallest) id is smaller than the missing one,
+        since thats where we would have passed where this would be
+        """
+        assert missing_id > 1
+        index = bisect_right(self._boundaries, -missing_id)
+        if index == len(self._boundaries):
+            raise RuntimeError(f"Could not find page for {missing_id}")
+        return index + 1
+
+    def pages(self, missing_ids: Iterable[int]) -> List[int]:
+        return [self.page(mid) for mid in missing_ids]
+
+
 def _estimate_page(missing_id: int, sorted_ids: list[int]) -> int:
     """
     Estimate the page number of a missing (entry which was just approved) entry
+
+    builds a PageIndex each call, use that directly to lookup more than one id
     """
-    assert missing_id > 1
-    for page, chunk in enumerate(chunked(sorted_ids, 50), 1):
-        # if the last page on this ID is smaller than the missing one, then we've passed where this would be
-        if chunk[-1] < missing_id:
-            return page
-    # check all pages?
-    # return len(sorted_ids) // 50
-    raise RuntimeError(f"Could not find page for {missing_id}")
+    return PageIndex(sorted_ids).page(missing_id)
+
+
+def test_page_index() -> None:
+    sorted_ids = sorted(range(2, 5000, 3), reverse=True)
+    index = PageIndex(sorted_ids)
+
+    def _linear(missing_id: int) -> int:
+        for page, chunk in enumerate(chunked(sorted_ids, 50), 1):
+            if chunk[-1] < missing_id:
+                return page
+        raise RuntimeError(missing_id)
+
+    ids = list(range(3, 5100))
+    assert index.pages(ids) == [_linear(i) for i in ids]
+    assert index.last_page == len(list(chunked(sorted_ids, 50)))
+    try:
+        index.page(2)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("expected RuntimeError for id smaller than all pages")
+
+
+def _estimate_user_pages(list_type: str, username: str, approved: ApprovedList) -> int:
+    recently_updated_ids = user_recently_updated(
+        list_type=list_type, username=username, offset=0
+    )
+    missing_approved = approved.missing(recently_updated_ids)
+    if len(missing_approved) == 0:
+        return 0
+    return max(approved.page_index.pages(missing_approved)) + 1
 
 
 def estimate_using_user_recent(list_type: str, username: str) -> int:
@@ -190,22 +588,9 @@ def estimate_using_user_recent(list_type: str, username: str) -> int:
     """
     assert list_type in {"anime", "manga"}
     logger.info(f"Estimating {list_type}list using {username}")
-    appr = approved_ids()
-    recently_updated_ids = user_recently_updated(
-        list_type=list_type, username=username, offset=0
+    max_page = _estimate_user_pages(
+        list_type, username, approved_ids().for_type(list_type)
     )
-    ids = appr.anime if list_type == "anime" else appr.manga
-    sorted_approved = list(sorted(ids, reverse=True))
-    missing_approved = []
-    for aid in recently_updated_ids:
-        if aid not in ids:
-            missing_approved.append(aid)
-    estimate_pages = [_estimate_page(aid, sorted_approved) for aid in missing_approved]
-    max_page: int
-    if len(estimate_pages) == 0:
-        max_page = 0
-    else:
-        max_page = max(estimate_pages) + 1
     logger.info(f"Estimated {max_page} {list_type} pages for {username}")
     return max_page
 
@@ -213,14 +598,126 @@ def estimate_using_user_recent(list_type: str, username: str) -> int:
 def estimate_all_users_max(
     user_names: List[str],
     check_type: str = "anime",
+    workers: int = 4,
 ) -> int:
-    max_pages = [estimate_using_user_recent(check_type, u) for u in user_names]
-    return max(max_pages)
+    """
+    Estimates the max page using each users recently updated list
+
+    the approved ids are loaded/sorted once, and the user lists are requested
+    from a thread pool (still spaced out by mal_list_limiter). If a user has
+    an entry on the last page, no other user can make the estimate
+    larger, so the remaining users are skipped
+    """
+    assert check_type in {"anime", "manga"}
+    approved = approved_ids().for_type(check_type)
+    # _estimate_user_pages returns at most the last page, plus one
+    page_bound = approved.page_index.last_page + 1
+
+    def _probe(username: str) -> Tuple[int, float]:
+        start = time.perf_counter()
+        pages = _estimate_user_pages(check_type, username, approved)
+        return pages, time.perf_counter() - start
+
+    max_page = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_probe, u): u for u in user_names}
+        for fut in as_completed(futures):
+            pages, took = fut.result()
+            logger.info(
+                f"Estimated {pages} {check_type} pages for {futures[fut]} (took {took:.2f}s)"
+            )
+            max_page = max(max_page, pages)
+            if max_page >= page_bound:
+                logger.info(f"Reached last page ({page_bound}), skipping other users")
+                for f in futures:
+                    f.cancel()
+                break
+    return max_page
 
 
-def estimate_deleted_entry(animelist_xml: Path) -> int:
-    from mal_id.metadata_cache import mal_api_session
+# how long to trust a previous probe of an entry before requesting it again
+PROBE_FOUND_TTL = 60 * 60 * 24
+PROBE_DELETED_TTL = 60 * 60 * 24 * 7
 
+
+class DeletedProbeCache:
+    """
+    saves whether an anime returned a 404 from the MAL API,
+    so repeated runs don't re-request entries which were already checked
+    """
+
+    def __init__(self, path: Path = deleted_probe_cache_path) -> None:
+        self.path = path
+        self.lock = Lock()
+        self.data: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            self.data = orjson.loads(self.path.read_bytes())
+
+    def get(self, mal_id: int) -> Optional[bool]:
+        """returns whether this was deleted, or None if it needs to be probed"""
+        if (item := self.data.get(str(mal_id))) is None:
+            return None
+        ttl = PROBE_DELETED_TTL if item["deleted"] else PROBE_FOUND_TTL
+        if item["at"] < time.time() - ttl:
+            return None
+        return bool(item["deleted"])
+
+    def put(self, mal_id: int, deleted: bool) -> None:
+        with self.lock:
+            self.data[str(mal_id)] = {"deleted": deleted, "at": time.time()}
+
+    def save(self) -> None:
+        now = time.time()
+        with self.lock:
+            # drop anything which has expired
+            self.data = {
+                k: v for k, v in self.data.items() if v["at"] > now - PROBE_DELETED_TTL
+            }
+            self.path.write_bytes(orjson.dumps(self.data))
+
+
+def _probe_deleted(mal_id: int) -> Optional[bool]:
+    """
+    returns whether MAL returned a 404 for this anime, or None if the
+    request failed some other way. If the token expired, its refreshed
+    and the request is retried once
+    """
+    from mal_id.metadata_cache import (
+        MAL_API_BASE,
+        mal_api_session,
+        mal_api_limiter,
+        refresh_token,
+    )
+
+    for _ in range(2):
+        mal_api_limiter.wait()
+        requested_at = time.monotonic()
+        try:
+            resp = mal_api_session().session.get(f"{MAL_API_BASE}/anime/{mal_id}")
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"failed to probe {mal_id}: {e}")
+            return None
+        if resp.status_code == 401:
+            refresh_token(requested_at)
+            continue
+        if resp.status_code == 404:
+            return True
+        if resp.status_code == 200:
+            return False
+        logger.warning(f"unexpected status {resp.status_code} probing {mal_id}")
+        return None
+    return None
+
+
+def estimate_deleted_entry(animelist_xml: Path, workers: int = 4) -> int:
+    """
+    The approved ids which aren't on my list (which has every approved entry)
+    may have been deleted. Probes those against the MAL API, smallest ids
+    first, and returns the page of the first one which 404s
+
+    the probes are made in batches of 'workers' (still spaced out
+    by the shared MAL API limiter), stopping after the first batch with a 404
+    """
     assert animelist_xml.exists()
 
     try:
@@ -229,22 +726,26 @@ def estimate_deleted_entry(animelist_xml: Path) -> int:
         logger.exception(str(e), exc_info=e)
         return 0
 
-    anime_ids = approved_ids().anime
-    deleted_ids: Set[int] = anime_ids - my_user_ids
+    approved = approved_ids().anime_list
+    deleted_ids = approved.difference(my_user_ids)
 
     if len(deleted_ids) == 0:
         return 0
 
-    sess = mal_api_session()
-    sorted_ids = sorted(anime_ids, reverse=True)
-
-    for mid in sorted(deleted_ids):
-        resp = sess.session.get(f"https://api.myanimelist.net/v2/anime/{mid}")
-        time.sleep(1)
-        if resp.status_code == 401:
-            sess.refresh_token()
-            return estimate_deleted_entry(animelist_xml)
-        elif resp.status_code == 404:
-            return _estimate_page(mid, sorted_ids)
+    probe_cache = DeletedProbeCache()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for batch in chunked(deleted_ids, workers):
+                to_probe = [mid for mid in batch if probe_cache.get(mid) is None]
+                for mid, deleted in zip(to_probe, pool.map(_probe_deleted, to_probe)):
+                    if deleted is not None:
+                        probe_cache.put(mid, deleted)
+                # batch is in ascending order, so the first one is the largest page
+                for mid in batch:
+                    if probe_cache.get(mid):
+                        logger.info(f"anime {mid} was deleted")
+                        return approved.page_index.page(mid)
+    finally:
+        probe_cache.save()
 
     return 0
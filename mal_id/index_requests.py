@@ -3,13 +3,14 @@ Interact with the /api/pages index endpoint.
 https://github.com/Hiyori-API/checker_mal
 """
 
+import os
 from typing import NamedTuple, Dict, Any, Optional, List, cast
 
 import requests
 
 from mal_id.log import logger
 
-INDEX_BASE = "http://localhost:4001/api"
+INDEX_BASE = os.environ.get("DBSENTINEL_INDEX_BASE", "http://localhost:4001/api")
 
 
 def _debug() -> Dict[str, Any]:
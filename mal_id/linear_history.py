@@ -1,16 +1,18 @@
 import io
 from pathlib import Path
 from datetime import datetime, timezone
-from typing import NamedTuple, Iterator, Any
+from typing import NamedTuple, Iterator, Any, TYPE_CHECKING
 
 import orjson
-from git.objects import Tree
-from git.objects.commit import Commit
-from git.repo.base import Repo
 
 from mal_id.paths import mal_id_cache_dir, linear_history_cleaned
 from mal_id.common import to_utc
 
+if TYPE_CHECKING:
+    # GitPython is only needed to walk the mal-id-cache history
+    from git.objects import Tree
+    from git.objects.commit import Commit
+
 
 class Entry(NamedTuple):
     entry_id: int
@@ -55,7 +57,7 @@ ANIME_EXPECTED = ["cache/anime_cache.json", "anime_cache.json", "cache.json"]
 MANGA_EXPECTED = ["cache/manga_cache.json", "manga_cache.json"]
 
 
-def _get_blob(tree: Tree, keys: list[str]) -> JsonData | None:
+def _get_blob(tree: "Tree", keys: list[str]) -> JsonData | None:
     for expected in keys:
         try:
             blob = tree / expected
@@ -72,7 +74,7 @@ def _get_blob(tree: Tree, keys: list[str]) -> JsonData | None:
     return None
 
 
-def snapshot_commit(commit: Commit) -> Iterator[Snapshot]:
+def snapshot_commit(commit: "Commit") -> Iterator[Snapshot]:
     if anime := _get_blob(commit.tree, ANIME_EXPECTED):
         assert set(anime.keys()) == {"nsfw", "sfw"}
         yield Snapshot(anime, "anime", dt=to_utc(commit.authored_datetime))
@@ -82,6 +84,8 @@ def snapshot_commit(commit: Commit) -> Iterator[Snapshot]:
 
 
 def iter_snapshots(repo: Path) -> Iterator[Snapshot]:
+    from git.repo.base import Repo
+
     r = Repo(str(repo))
     commits = list(r.iter_commits())
     commits.sort(key=lambda c: c.committed_date)
@@ -92,6 +96,7 @@ def iter_snapshots(repo: Path) -> Iterator[Snapshot]:
 def track_diffs() -> Iterator[Entry]:
     anime: set[int] = set()
     manga: set[int] = set()
+    assert mal_id_cache_dir.exists(), f"{mal_id_cache_dir} doesn't exist"
     for sn in iter_snapshots(mal_id_cache_dir):
         assert sn.entry_type in {"anime", "manga"}
         state = anime if sn.entry_type == "anime" else manga
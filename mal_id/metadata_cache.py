@@ -1,7 +1,7 @@
 import os
 import time
 import logging
-from typing import Any
+from typing import Any, Optional, TYPE_CHECKING
 from functools import cache
 from pathlib import Path
 from datetime import datetime, timedelta
@@ -10,26 +10,40 @@ from threading import Lock
 import click
 import requests
 
-from malexport.exporter.mal_session import MalSession
-from malexport.exporter.account import Account
 from url_cache.core import URLCache
 from url_cache.model import Summary
 
 from mal_id.paths import metadatacache_dir
 from mal_id.log import logger
+from mal_id.common import RateLimiter
+from mal_id.cache_health import classify_summary, SummaryHealth, BROKEN
+from mal_id.summary_lru import SummaryLRU
+
+if TYPE_CHECKING:
+    # malexport.exporter is slow to import, only needed once something is requested
+    from malexport.exporter.mal_session import MalSession
 
 
 class MALIsDownError(Exception):
     pass
 
 
-MAL_API_LOCK = Lock()
+# max size of the in-memory summaries kept by MetadataCache
+METADATA_LRU_MAX_BYTES = int(os.environ.get("METADATA_LRU_MAX_BYTES", 64 * 1024 * 1024))
+
+# can point at a local stand-in, see scripts/stub_services
+MAL_API_BASE = os.environ.get(
+    "DBSENTINEL_MAL_API_BASE", "https://api.myanimelist.net/v2"
+)
+
+# shared by anything which makes requests to the MAL API, across threads
+mal_api_limiter = RateLimiter(1.0)
 
 
-def api_request(session: MalSession, url: str, recursed_times: int = 0) -> Any:
-    with MAL_API_LOCK:
-        time.sleep(1)
-        resp: requests.Response = session.session.get(url)
+def api_request(session: "MalSession", url: str, recursed_times: int = 0) -> Any:
+    mal_api_limiter.wait()
+    requested_at = time.monotonic()
+    resp: requests.Response = session.session.get(url)
 
     # sometimes 400 happens if the alternative titles are empty
     if resp.status_code == 400 and "alternative_titles," in url:
@@ -42,7 +56,7 @@ def api_request(session: MalSession, url: str, recursed_times: int = 0) -> Any:
     # if token expired, refresh
     if resp.status_code == 401:
         logger.warning("token expired, refreshing")
-        refresh_token()
+        refresh_token(requested_at)
         resp.raise_for_status()
 
     # if this is an unexpected API failure, and not an expected 404/429/400, wait for a while before retrying
@@ -79,7 +93,9 @@ def api_request(session: MalSession, url: str, recursed_times: int = 0) -> Any:
 
 
 @cache
-def mal_api_session() -> MalSession:
+def mal_api_session() -> "MalSession":
+    from malexport.exporter.account import Account
+
     assert "MAL_USERNAME" in os.environ
     acc = Account.from_username(os.environ["MAL_USERNAME"])
     acc.mal_api_authenticate()
@@ -87,14 +103,28 @@ def mal_api_session() -> MalSession:
     return acc.mal_session
 
 
-def refresh_token() -> None:
-    mal_api_session().refresh_token()
+TOKEN_LOCK = Lock()
+_token_refreshed_at = 0.0
+
+
+def refresh_token(requested_at: Optional[float] = None) -> None:
+    """
+    requested_at is the time.monotonic() when the request which got
+    a 401 was sent. If another thread already refreshed the token
+    after that, this doesn't refresh it again
+    """
+    global _token_refreshed_at
+    with TOKEN_LOCK:
+        if requested_at is not None and _token_refreshed_at > requested_at:
+            return
+        mal_api_session().refresh_token()
+        _token_refreshed_at = time.monotonic()
 
 
 def check_mal() -> bool:
     try:
         logger.info("checking if MAL API is up...")
-        resp = mal_api_session().session.get("https://api.myanimelist.net/v2/anime/1")
+        resp = mal_api_session().session.get(f"{MAL_API_BASE}/anime/1")
         if resp.status_code == 401:
             refresh_token()
             return check_mal()
@@ -110,20 +140,47 @@ def check_mal() -> bool:
 
 
 class MetadataCache(URLCache):
-    BASE_ANIME_URL = "https://api.myanimelist.net/v2/anime/{}?nsfw=true"
+    BASE_ANIME_URL = MAL_API_BASE + "/anime/{}?nsfw=true"
 
     ANIME_FIELDS = "fields=id,title,main_picture,alternative_titles,start_date,end_date,synopsis,mean,rank,popularity,num_list_users,num_scoring_users,nsfw,created_at,updated_at,media_type,status,genres,num_episodes,start_season,broadcast,source,average_episode_duration,rating,pictures,background,related_anime,related_manga,recommendations,studios,statistics"
 
-    BASE_MANGA_URL = r"https://api.myanimelist.net/v2/manga/{}?nsfw=true"
+    BASE_MANGA_URL = MAL_API_BASE + "/manga/{}?nsfw=true"
 
     MANGA_FIELDS = "fields=id,title,main_picture,alternative_titles,start_date,end_date,synopsis,mean,rank,popularity,num_list_users,num_scoring_users,nsfw,created_at,updated_at,media_type,status,genres,num_volumes,num_chapters,authors{first_name,last_name},pictures,background,related_anime,related_manga,recommendations,serialization{name}"
 
     def __init__(
         self, cache_dir: Path = metadatacache_dir, loglevel: int = logging.INFO
     ) -> None:
-        self.mal_session = mal_api_session()
+        # so repeat lookups in the same process dont have to read from disk
+        self.lru = SummaryLRU(max_bytes=METADATA_LRU_MAX_BYTES)
         super().__init__(cache_dir=cache_dir, loglevel=loglevel)
 
+    @property
+    def mal_session(self) -> "MalSession":
+        # only authenticates once something actually has to be requested
+        return mal_api_session()
+
+    def get(self, url: str) -> Summary:
+        uurl = self.preprocess_url(url)
+        if (summary := self.lru.get(uurl)) is not None:
+            if (
+                self.expiry_duration is None
+                or summary.timestamp is None
+                or datetime.now() - summary.timestamp <= self.expiry_duration
+            ):
+                return summary
+        summary = super().get(uurl)
+        self.lru.put(uurl, summary)
+        return summary
+
+    def in_cache(self, url: str) -> bool:
+        return self.preprocess_url(url) in self.lru or super().in_cache(url)
+
+    def put(self, url: str, summary: Summary) -> None:
+        uurl = self.preprocess_url(url)
+        self.summary_cache.put(uurl, summary)
+        self.lru.put(uurl, summary)
+
     def request_data(self, url: str, preprocess_url: bool = True) -> Summary:
         mal_id = int(url.split("/")[-1])
         media_type = url.split("/")[-2]
@@ -217,43 +274,19 @@ class MetadataCache(URLCache):
 
     def refresh_data(self, url: str) -> Summary:
         uurl = self.preprocess_url(url)
+        self.lru.invalidate(uurl)
         summary = self.request_data(uurl)
-        self.summary_cache.put(uurl, summary)
+        self.put(uurl, summary)
         return summary
 
     @staticmethod
     def is_404(summary: Summary) -> bool:
-        if "error" in summary.metadata:
-            return bool(summary.metadata["error"] == 404)
-        return False
+        return classify_summary(summary) == SummaryHealth.NOT_FOUND
 
     @staticmethod
     def has_broken_data(summary: Summary) -> bool:
-        if "error" in summary.metadata and summary.metadata["error"] in {
-            429,
-            504,
-        }:  # 429 probably has never happened
-            return True
-
-        if "currently under maintenance" in summary.metadata.get("message", "").lower():
-            return True
-        if summary.metadata.get("id") in {-1, 0}:
-            return True
-        # this is a sort of broken response that MAL returns sometimes when its down
-        # {'id': -1, 'title': 'Title', 'num_chapters': 0, 'status': 'currently_publishing', 'media_type': 'manga'}
-        if (
-            set(summary.metadata.keys()).issubset(
-                {"id", "title", "num_chapters", "status", "num_episodes", "media_type"}
-            )
-            and (
-                summary.metadata.get("num_episodes") == 0
-                or summary.metadata.get("num_chapters") == 0
-            )
-            and summary.metadata.get("title", "").lower()
-            in {"title", "", "blocked.", "blocked"}
-        ):
-            return True
-        return False
+        """see mal_id/cache_health.py for the cases this checks for"""
+        return classify_summary(summary) in BROKEN
 
     @staticmethod
     def has_basic_data(summary: Summary) -> bool:
@@ -274,9 +307,11 @@ def request_metadata(
     *,
     rerequest_failed: bool = False,
     force_rerequest: bool = False,
-    mcache: MetadataCache = metadata_cache(),
+    mcache: Optional[MetadataCache] = None,
 ) -> Summary:
     assert entry_type in {"anime", "manga"}
+    if mcache is None:
+        mcache = metadata_cache()
     # use this as the key for the cache
     url_key = "https://myanimelist.net/{}/{}".format(entry_type, id_)
     # if this had failed previously, try again
@@ -322,4 +357,4 @@ def has_metadata(
     assert entry_type in {"anime", "manga"}
     # use this as the key for the cache
     url_key = "https://myanimelist.net/{}/{}".format(entry_type, id_)
-    return metadata_cache().summary_cache.has(url_key)
+    return metadata_cache().in_cache(url_key)
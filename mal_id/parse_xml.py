@@ -1,8 +1,72 @@
-from typing import Set
+import gzip
+from typing import Set, List, Dict, Union, BinaryIO
 from pathlib import Path
+from xml.etree import ElementTree
 
-from malexport.parse.xml import parse_xml
+# the only field we need from each list entry
+ID_TAGS = {"series_animedb_id", "manga_mangadb_id"}
 
 
-def parse_user_ids(xml_file: Path) -> Set[int]:
-    return {ent.id for ent in parse_xml(xml_file).entries}
+def _open_export(xml_file: Path) -> Union[gzip.GzipFile, BinaryIO]:
+    """opens the export, decompressing it if its gzipped (e.g. animelist.xml.gz)"""
+    with xml_file.open("rb") as f:
+        magic = f.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(xml_file, "rb")
+    return xml_file.open("rb")
+
+
+class _IdCollector:
+    """
+    parser target which only keeps the text of the id tags,
+    every other element is dropped as soon as expat parses it
+    """
+
+    def __init__(self) -> None:
+        self.ids: Set[int] = set()
+        self._in_id = False
+        self._text: List[str] = []
+
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
+        if tag in ID_TAGS:
+            self._in_id = True
+            self._text = []
+
+    def data(self, data: str) -> None:
+        if self._in_id:
+            self._text.append(data)
+
+    def end(self, tag: str) -> None:
+        if self._in_id and tag in ID_TAGS:
+            self.ids.add(int("".join(self._text)))
+            self._in_id = False
+
+    def close(self) -> Set[int]:
+        return self.ids
+
+
+def parse_user_ids(xml_file: Path, chunk_size: int = 64 * 1024) -> Set[int]:
+    """
+    streams the ids from a MAL list export, without building the entries
+    or the element tree, so memory usage doesn't grow with the size of the list
+    """
+    parser = ElementTree.XMLParser(target=_IdCollector())
+    with _open_export(xml_file) as f:
+        while chunk := f.read(chunk_size):
+            parser.feed(chunk)
+    ids: Set[int] = parser.close()
+    return ids
+
+
+def test_parse_user_ids(tmp_path: Path) -> None:
+    entries = "".join(
+        f"<anime><series_animedb_id>{i}</series_animedb_id><series_title><![CDATA[t]]></series_title></anime>"
+        for i in (1, 5, 20)
+    )
+    data = f"<?xml version='1.0' encoding='UTF-8' ?><myanimelist><myinfo><user_export_type>1</user_export_type></myinfo>{entries}</myanimelist>"
+    xml_file = tmp_path / "animelist.xml"
+    xml_file.write_text(data)
+    gz_file = tmp_path / "animelist.xml.gz"
+    gz_file.write_bytes(gzip.compress(data.encode()))
+    assert parse_user_ids(xml_file) == {1, 5, 20}
+    assert parse_user_ids(gz_file) == {1, 5, 20}
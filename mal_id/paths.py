@@ -1,18 +1,19 @@
+import os
 from pathlib import Path
 
 root_dir = Path(__file__).parent.parent.absolute()
-data_dir = root_dir / "data"
+# can be pointed somewhere else, e.g. at generated data in scripts/bench_suite
+data_dir = Path(os.environ.get("DBSENTINEL_DATA_DIR", root_dir / "data")).absolute()
 if not data_dir.exists():
     data_dir.mkdir(parents=True)
+# these are checked where they're read, so commands which dont need them still work
 mal_id_cache_dir = data_dir / "mal-id-cache"
-assert mal_id_cache_dir.exists()
 
 linear_history_unmerged = data_dir / "data.jsonl"
 linear_history_cleaned = data_dir / "data_cleaned.jsonl"
 metadatacache_dir = data_dir / "metadata"
 
 arm_dir = data_dir / "arm"
-assert arm_dir.exists()
 
 anilist_cache = data_dir / "anilist_cache"
 
@@ -25,7 +26,11 @@ if not unapproved_dir.exists():
 
 unapproved_anime_path = unapproved_dir / "anime.json"
 unapproved_manga_path = unapproved_dir / "manga.json"
+# the last unapproved delta (see mal_id/ids.py) the db update has processed
+unapproved_cursor_path = unapproved_dir / "db_cursor.json"
 
 image_data = data_dir / "image_info.json"
 
 my_animelist_xml = data_dir / "animelist.xml"
+deleted_probe_cache_path = data_dir / "deleted_probe_cache.json"
+refresh_schedule_path = data_dir / "refresh_schedule.json"
@@ -0,0 +1,98 @@
+"""
+A size-bounded, in-memory LRU for Summary objects, so looking up the
+same url more than once in a process doesn't have to read/parse it from disk
+"""
+
+from threading import Lock
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import orjson
+from url_cache.model import Summary
+
+
+def summary_size(summary: Summary) -> int:
+    """approximate size, using the length of the serialized metadata"""
+    return len(summary.url) + len(orjson.dumps(summary.metadata))
+
+
+class SummaryLRU:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+        self._items: OrderedDict[str, Tuple[Summary, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._items
+
+    def get(self, url: str) -> Optional[Summary]:
+        with self._lock:
+            item = self._items.get(url)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(url)
+            self.hits += 1
+            return item[0]
+
+    def put(self, url: str, summary: Summary) -> None:
+        size = summary_size(summary)
+        with self._lock:
+            self._remove(url)
+            # larger than the whole cache, dont keep it
+            if size > self.max_bytes:
+                return
+            self._items[url] = (summary, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, url: str) -> None:
+        with self._lock:
+            self._remove(url)
+
+    def _remove(self, url: str) -> None:
+        if (item := self._items.pop(url, None)) is not None:
+            self.current_bytes -= item[1]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "items": len(self._items),
+            "bytes": self.current_bytes,
+        }
+
+
+def test_summary_lru() -> None:
+    def _summary(i: int) -> Summary:
+        return Summary(url=f"u{i}", data={}, metadata={"id": i, "title": "x" * 50})
+
+    size = summary_size(_summary(1))
+    lru = SummaryLRU(max_bytes=size * 2)
+    assert lru.get("u1") is None
+    lru.put("u1", _summary(1))
+    lru.put("u2", _summary(2))
+    assert lru.get("u1") is not None
+    # u2 is the least recently used now
+    lru.put("u3", _summary(3))
+    assert "u2" not in lru and "u1" in lru and "u3" in lru
+    lru.invalidate("u1")
+    assert lru.get("u1") is None
+    assert lru.stats() == {
+        "hits": 1,
+        "misses": 2,
+        "evictions": 1,
+        "items": 1,
+        "bytes": size,
+    }